@@ -27,6 +27,45 @@ sub bib
    {my ($self, $os, %o) = @_;
     return $self->command('bib', ds => $os, %o)->{value};}
 
+sub bib_multi
+# Takes an array reference of items and one of targets, each an
+# array reference of a style path, a formatter name, and a hash
+# reference of options for `bib`, or a hash reference whose
+# values are such targets. Returns an array or hash reference,
+# respectively, of what `bib` would return for each target.
+   {my ($self, $os, $targets, %o) = @_;
+    return $self->command('bib_multi', ds => $os, targets => $targets, %o)->{value};}
+
+sub cites
+# Returns the inline citations of the items, as an array
+# reference, and their keys in bibliography order, as another,
+# without rendering the bibliography.
+   {my ($self, $os, %o) = @_;
+    return @{$self->command('cites', ds => $os, %o)->{value}};}
+
+sub duplicates
+# Returns an array reference of array references of the
+# positions of items that are the same work, as `bib` would
+# collapse them with `dedup => 1`.
+   {my ($self, $os, %o) = @_;
+    return $self->command('duplicates', ds => $os, %o)->{value};}
+
+sub bib_many
+# Takes an array reference of jobs, each a hash reference of
+# options for `bib1` (with the item as `d`) or `bib` (with
+# the items as `ds`). Returns an array reference of replies,
+# each a hash reference with either `value` or `error`.
+   {my ($self, $jobs) = @_;
+    return $self->command('batch', jobs =>
+        [map {{command => exists $_->{ds} ? 'bib' : 'bib1', args => $_}}
+            @$jobs])->{value};}
+
+sub stats
+# Returns the server's timings per phase and counters, as a
+# hash reference.
+   {my $self = shift;
+    return $self->command('stats')->{value};}
+
 # ------------------------------------------------------------
 # Private
 # ------------------------------------------------------------
@@ -36,7 +75,9 @@ sub init
     $self->{in} = '';
     $self->{out} = '';
     $self->{handle} = start
-        [$self->{python3_path}, '-m', 'quickbib'],
+        [$self->{python3_path}, '-m', 'quickbib', '--preload'],
+          # The server can get citeproc-py ready while we're
+          # still preparing our first command.
         \($self->{in}), \($self->{out})
       or die $?;
     return 1;}
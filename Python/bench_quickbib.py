@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- Python -*-
+#
+# Benchmarks for quickbib and citematic_coins. Say
+#
+#     python3 bench_quickbib.py --json results.json
+#
+# with APA_CSL_PATH set, and later
+#
+#     python3 bench_quickbib.py --compare results.json
+#
+# to see how the current code compares.
+
+from sys import stderr, platform, executable
+from os import environ
+from os.path import dirname, abspath
+from time import perf_counter, sleep
+from random import Random
+from itertools import cycle
+from io import BytesIO
+from argparse import ArgumentParser
+from copy import deepcopy
+import json, resource, subprocess, datetime, tracemalloc
+
+import quickbib
+from quickbib import bib, bib1, name
+from citematic_coins import coins, coins_many
+import csl_fixtures
+from csl_fixtures import merge_dicts, dashed
+
+# ------------------------------------------------------------
+# Synthetic corpora
+# ------------------------------------------------------------
+
+given_names = ['Joesph', 'J. Random', 'Mary-Jane', 'Þómas', 'Áine',
+    'Ōy', 'Richard X.', 'Kat', 'Anna', 'Christer', 'Bernard']
+family_names = ['Bloggs', 'Hacker', 'Sally', 'Turner', 'Ó Briain',
+    'Xyzzy', 'Roe', 'Gully', 'Dreber', 'Gerdes', 'Gränsmark',
+    'Apfelbaum', 'Lichtenberger', 'Kaufman', 'Ångström']
+words = '''aggregation assessment battery children chess decision
+    judgment knights light main perspectives power quails queens
+    reality research risk scattering sexual technique theory
+    uncertainty'''.split()
+
+def authors(rng, n = None):
+    return [name(rng.choice(given_names), rng.choice(family_names))
+        for _ in range(n or rng.choice([1, 1, 2, 2, 3, 4, 7, 8]))]
+
+def title(rng):
+    return ' '.join(rng.choice(words) for _ in range(rng.randint(2, 9))).capitalize()
+
+def jf(rng, **field_kws):
+    # `csl_fixtures.jf`, the tests' journal article, with randomized
+    # fields.
+    return dashed(csl_fixtures.jf(**merge_dicts(
+        dict(author = authors(rng),
+            issued = {'date-parts': [[rng.randint(1950, 2020)]]},
+            title = title(rng),
+            container_title = rng.choice(['Sciency Times', 'NeuroReport', 'Psychological Review']),
+            volume = str(rng.randint(1, 120)), issue = str(rng.randint(1, 12)),
+            page = '{0}–{1}'.format(*sorted(rng.sample(range(1, 900), 2))),
+            DOI = '10.zzz/{}'.format(rng.getrandbits(32))),
+        field_kws)))
+
+def book(rng, **field_kws):
+    return jf(rng, **merge_dicts(
+        dict(type = 'book',
+            volume = None, issue = None, page = None, container_title = None,
+            publisher = 'Ric-Rac Press', publisher_place = 'Tuscon, AZ',
+            ISBN = '0123456789'),
+        field_kws))
+
+def chapter(rng, **field_kws):
+    return book(rng, **merge_dicts(
+        dict(type = 'chapter',
+            page = '{}–{}'.format(12, rng.randint(13, 60)),
+            container_title = title(rng),
+            editor = authors(rng, rng.randint(1, 3))),
+        field_kws))
+
+def report(rng):
+    return dashed(dict(type = 'report', author = authors(rng),
+        issued = {'date-parts': [[rng.randint(1990, 2020)]]},
+        title = title(rng), genre = 'Discussion Paper No. {}'.format(rng.randint(1, 9999)),
+        publisher = 'Institute for the Study of Labor',
+        URL = 'http://ftp.iza.org/dp{}.pdf'.format(rng.randint(1, 9999))))
+
+def speech(rng):
+    return dashed(dict(type = 'speech', author = authors(rng),
+        issued = {'date-parts': [[rng.randint(1980, 2020), rng.randint(1, 12)]]},
+        title = title(rng), genre = rng.choice(['paper', 'video']),
+        publisher = 'American Association of the Advancement of Science',
+        event_place = 'San Francisco, CA', URL = 'http://example.com'))
+
+def software(rng):
+    return dashed(dict(type = 'software', author = [dict(family = 'Stan Development Team')],
+        issued = {'date-parts': [[rng.randint(2000, 2020)]]},
+        title = title(rng), version = '2.{}.0'.format(rng.randint(0, 30)),
+        URL = 'http://mc-stan.org'))
+
+def corpus(n, kind = 'mixed', seed = 1):
+    # "mixed" draws from all the item types. "collisions" is
+    # journal articles by a handful of authors in a few years,
+    # so that most works need year suffixes.
+    rng = Random(seed)
+    if kind == 'collisions':
+        people = [authors(rng, rng.choice([1, 2, 3])) for _ in range(max(1, n // 45))]
+        make = lambda: jf(rng, author = rng.choice(people),
+            issued = {'date-parts': [[rng.randint(2000, 2002)]]})
+    else:
+        makers = [jf] * 5 + [book, chapter, chapter, report, speech, software]
+        make = lambda: rng.choice(makers)(rng)
+    return [dict(make(), id = 'item{}'.format(i)) for i in range(n)]
+
+# ------------------------------------------------------------
+# Measurement
+# ------------------------------------------------------------
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if platform == 'darwin' else rss
+      # macOS reports bytes; Linux, kilobytes.
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(p / 100 * (len(xs) - 1))))]
+
+def measure(f, setup = None, items = 1, min_reps = 3, budget = 2.0):
+    # Call `f` at least `min_reps` times and until `budget`
+    # seconds have passed. `setup`, if provided, is called (untimed)
+    # before each call. `items` is how many things each call
+    # processes, for computing throughput. If `f` returns a
+    # float, that's taken as the time to record, in seconds.
+    times = []
+    start = perf_counter()
+    while len(times) < min_reps or perf_counter() - start < budget:
+        if setup: setup()
+        t = perf_counter()
+        elapsed = f()
+        t = perf_counter() - t
+        times.append(elapsed if isinstance(elapsed, float) else t)
+    return dict(
+        reps = len(times),
+        ops_per_sec = len(times) / sum(times),
+        items_per_sec = items * len(times) / sum(times),
+        p50_ms = 1000 * percentile(times, 50),
+        p99_ms = 1000 * percentile(times, 99),
+        peak_rss_kb = peak_rss_kb())
+
+def traced_peak_kb(f):
+    # The most memory Python allocated during `f()`, including
+    # what `f` returns.
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+def without_entry_cache(f):
+    def g():
+        saved = quickbib.entry_cache
+        quickbib.entry_cache = None
+        try:
+            f()
+        finally:
+            quickbib.entry_cache = saved
+    return g
+
+def with_compiled(f):
+    def g():
+        saved = quickbib.compiled_types
+        quickbib.compiled_types = ('article-journal', 'chapter', 'book')
+        try:
+            f()
+        finally:
+            quickbib.compiled_types = saved
+    return g
+
+def first_reply(style_path, flags = (), delay = 0):
+    # Start an IPC server, wait `delay` seconds, and send it a
+    # `bib1` command. Return the time from spawning (or, with a
+    # delay, from sending) until the reply arrives.
+    t = perf_counter()
+    p = subprocess.Popen([executable, '-m', 'quickbib'] + list(flags),
+        cwd = dirname(abspath(quickbib.__file__)),
+        stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+        universal_newlines = True)
+    if delay:
+        sleep(delay)
+        t = perf_counter()
+    p.stdin.write(json.dumps(dict(command = 'bib1', args = dict(
+        style_path = style_path, formatter = 'html',
+        d = corpus(1)[0]))) + '\n')
+    p.stdin.flush()
+    reply = json.loads(p.stdout.readline())
+    elapsed = perf_counter() - t
+    p.stdin.write('{"command": "quit"}\n')
+    p.stdin.close()
+    p.wait()
+    assert 'value' in reply, reply
+    return elapsed
+
+def benchmarks(style_path, sizes, budget):
+    # Yield (name, thunk) pairs. Each thunk returns a result
+    # dictionary from `measure`.
+
+    yield 'get_style cold', lambda: measure(
+        lambda: quickbib.get_style(style_path, True, False, False, True),
+        setup = quickbib.style_cache.clear, budget = budget)
+    yield 'get_style warm', lambda: measure(
+        lambda: quickbib.get_style(style_path, True, False, False, True),
+        items = 1, min_reps = 100, budget = budget)
+
+    # The client's view of startup: how long a freshly spawned
+    # server takes to answer its first command. The target is
+    # 100 ms, but note that just starting `python3` takes a good
+    # part of that on some machines.
+    yield 'startup to first bib1', lambda: measure(
+        lambda: first_reply(style_path), budget = budget)
+    yield 'startup to first bib1, --preload', lambda: measure(
+        lambda: first_reply(style_path, ['--preload']), budget = budget)
+    yield 'first bib1 200 ms after startup, --preload', lambda: measure(
+        lambda: first_reply(style_path, ['--preload', '--style', style_path], .2),
+        budget = budget)
+
+    # What an IPC client sees for each new item: a `bib1` call that
+    # misses the entry cache.
+    items = cycle(corpus(500, seed = 2))
+    yield 'bib1 latency, entry cache off', lambda: measure(
+        without_entry_cache(lambda: bib1(style_path, next(items), formatter = 'html')),
+        min_reps = 100, budget = budget)
+
+    # Preparing each item for citeproc-py, copying it with
+    # `deepcopy` first (as `bib` used to) or letting `tweak` copy
+    # only what it changes. Since peak RSS only goes up over a run,
+    # memory is compared by Python's traced peak instead.
+    ds = corpus(5000, seed = 4)
+    options = (True, False, True, True)
+    for copy_first in (True, False):
+        f = lambda copy_first = copy_first: [
+            quickbib.tweak(deepcopy(d) if copy_first else d, {'id': d['id']}, *options)
+            for d in ds]
+        yield ('tweak x{}, {}'.format(len(ds), 'deepcopy' if copy_first else 'copy-on-write'),
+            lambda f = f: dict(measure(f, items = len(ds), budget = budget),
+                peak_traced_kb = traced_peak_kb(f)))
+
+    # What an editor sees when it refreshes a document's inline
+    # citations.
+    ds = corpus(1000, seed = 3)
+    yield 'cites x1000, cite cache warm', lambda: (quickbib.cites(style_path, ds),
+        measure(lambda: quickbib.cites(style_path, ds), items = len(ds), budget = budget))[1]
+    yield 'bib x1000 cites and keys, entry cache warm', lambda: (
+        bib(style_path, ds, return_cites_and_keys = True),
+        measure(lambda: bib(style_path, ds, return_cites_and_keys = True),
+            items = len(ds), budget = budget))[1]
+
+    # Publishing one bibliography in several forms.
+    targets = [(style_path, f, o)
+        for f in ('html', 'plain') for o in ({}, dict(include_isbn = True))]
+    yield 'bib x1000 for 4 targets, separately, entry cache warm', lambda: (
+        quickbib.bib_multi(ds, targets),
+        measure(lambda: [bib(p, ds, formatter = f, **o) for p, f, o in targets],
+            items = len(ds) * len(targets), budget = budget))[1]
+    yield 'bib_multi x1000 for 4 targets, entry cache warm', lambda: (
+        quickbib.bib_multi(ds, targets),
+        measure(lambda: quickbib.bib_multi(ds, targets),
+            items = len(ds) * len(targets), budget = budget))[1]
+
+    for kind in ('mixed', 'collisions'):
+        for n in sizes:
+            ds = corpus(n, kind)
+            for formatter in ('chocolate', 'html', 'plain'):
+                call = lambda ds = ds, formatter = formatter: bib(
+                    style_path, ds, formatter = formatter)
+                yield ('bib {} x{} {}'.format(kind, n, formatter),
+                    lambda call = call, n = n: measure(without_entry_cache(call),
+                        items = n, min_reps = 1 if n > 1000 else 3, budget = budget))
+            call = lambda ds = ds: bib(style_path, ds, formatter = 'html')
+            yield ('bib {} x{} html, compiled'.format(kind, n),
+                lambda call = call, n = n: measure(without_entry_cache(with_compiled(call)),
+                    items = n, min_reps = 1 if n > 1000 else 3, budget = budget))
+            call = lambda ds = ds: bib(style_path, ds, formatter = 'chocolate')
+            yield ('bib {} x{} chocolate, entry cache warm'.format(kind, n),
+                lambda call = call, n = n: (call(), measure(call,
+                    items = n, min_reps = 1 if n > 1000 else 3, budget = budget))[1])
+
+    ds = corpus(max(sizes))
+    yield 'coins x{}'.format(len(ds)), lambda: measure(
+        lambda: [coins(d) for d in ds], items = len(ds), budget = budget)
+    yield 'coins_many x{}'.format(len(ds)), lambda: measure(
+        lambda: list(coins_many(ds)), items = len(ds), budget = budget)
+
+    # Encoding and decoding a big `bib` reply, in each IPC framing.
+    def framing(codec_name):
+        def thunk():
+            f = quickbib.Framing(codec_name)
+            r = dict(value = bib(style_path, ds), id = 1)
+            def round_trip():
+                b = BytesIO()
+                f.write(b, r)
+                b.seek(0)
+                f.read(b)
+            return measure(round_trip, items = len(ds), budget = budget)
+        return thunk
+    for codec_name in (None, 'json', 'orjson', 'msgpack'):
+        if codec_name is None or quickbib.codec(codec_name):
+            yield ('IPC reply x{}, {}'.format(len(ds), codec_name or 'JSON lines'),
+                framing(codec_name))
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            stderr = subprocess.DEVNULL, universal_newlines = True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def show(name, r, old = None):
+    line = '{:50} {:12.1f} items/s  p50 {:9.3f} ms  p99 {:9.3f} ms  RSS {:7d} KB'.format(
+        name, r['items_per_sec'], r['p50_ms'], r['p99_ms'], r['peak_rss_kb'])
+    if 'peak_traced_kb' in r:
+        line += '  traced {:7d} KB'.format(r['peak_traced_kb'])
+    if old is not None:
+        line += '  ({:+.0%} vs. baseline)'.format(
+            r['items_per_sec'] / old['items_per_sec'] - 1)
+    print(line)
+
+# ------------------------------------------------------------
+# Mainline code
+# ------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description = 'Benchmark quickbib and citematic_coins.')
+    parser.add_argument('--style', default = environ.get('APA_CSL_PATH'),
+        help = 'the CSL style to use (default: $APA_CSL_PATH)')
+    parser.add_argument('--sizes', default = '1,100,10000',
+        help = 'comma-separated numbers of items per bib call (default: %(default)s)')
+    parser.add_argument('--budget', type = float, default = 2.0,
+        help = 'seconds to spend on each benchmark, at least (default: %(default)s)')
+    parser.add_argument('--only', metavar = 'SUBSTRING',
+        help = 'run only benchmarks whose names contain this')
+    parser.add_argument('--json', metavar = 'PATH',
+        help = 'save the results here')
+    parser.add_argument('--compare', metavar = 'PATH',
+        help = 'compare with results saved by an earlier run')
+    args = parser.parse_args()
+    if not args.style:
+        parser.error('Set APA_CSL_PATH or use --style')
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    for bname, thunk in benchmarks(args.style,
+            [int(n) for n in args.sizes.split(',')], args.budget):
+        if args.only and args.only not in bname:
+            continue
+        print(bname + '…', file = stderr, end = '\r')
+        results[bname] = thunk()
+        show(bname, results[bname], baseline.get(bname))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(
+                commit = git_commit(),
+                time = datetime.datetime.now().isoformat(),
+                style = args.style,
+                results = results), f, indent = 2)
@@ -0,0 +1,129 @@
+# A bibliography database (a YAML or JSON list of items, each a
+# dictionary with a unique `KEY` and CSL input data as `csl`),
+# parsed once and kept in SQLite.
+
+from os import environ, stat, makedirs
+from os.path import join, dirname, abspath, expanduser
+from hashlib import sha256
+import sqlite3, json, pickle
+
+# ----------------------------------------------------------
+# * Public
+# ----------------------------------------------------------
+
+class Database(object):
+    """The items of the database at `source_path`, in order or by
+    `KEY`. Of several items with the same `KEY`, only the last is
+    kept. The store (by default, under ~/.cache/citematic) is
+    rebuilt whenever the source's modification time or size
+    changes."""
+
+    def __init__(self, source_path, store_path = None):
+        self.source_path = abspath(source_path)
+        self.store_path = store_path or default_store_path(self.source_path)
+        makedirs(dirname(abspath(self.store_path)), exist_ok = True)
+        self.db = sqlite3.connect(self.store_path)
+        self.db.executescript(schema)
+        self.refresh()
+
+    def refresh(self):
+        st = stat(self.source_path)
+        version = json.dumps([store_version, st.st_mtime_ns, st.st_size])
+        row = self.db.execute("select value from meta where name = 'version'").fetchone()
+        if row is not None and row[0] == version:
+            return
+        with open(self.source_path, encoding = 'UTF-8') as o:
+            items = (json.load(o)
+                if self.source_path.endswith('.json')
+                else yaml_load(o))
+        with self.db:
+            self.db.execute('delete from items')
+            self.db.executemany('insert or replace into items values (?, ?, ?, ?)',
+                ((pos, x['KEY'], csl_hash(x['csl']), pickle.dumps(x))
+                    for pos, x in enumerate(items)))
+            self.db.execute('delete from outputs where key not in (select key from items)')
+            self.db.execute("insert or replace into meta values ('version', ?)",
+                (version,))
+
+    def __len__(self):
+        return self.db.execute('select count(*) from items').fetchone()[0]
+
+    def __contains__(self, key):
+        return self.db.execute('select 1 from items where key = ?',
+            (key,)).fetchone() is not None
+
+    def __getitem__(self, key):
+        row = self.db.execute('select item from items where key = ?',
+            (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __iter__(self):
+        for chunk in self.chunks('i.item', ''):
+            for _, item in chunk:
+                yield pickle.loads(item)
+
+    def outputs(self, tag, render_many):
+        """Yield a `KEY` and an output string for each item, in order.
+        `render_many` maps an iterable of items to an iterable of
+        their outputs. It's called only for items whose `csl` has
+        changed since an output was last saved for them under
+        `tag`."""
+        for chunk in self.chunks('i.key, i.hash, i.item, o.text',
+                'left join outputs o on o.tag = ? and o.key = i.key and o.hash = i.hash',
+                (tag,)):
+            stale = [r for r in chunk if r[4] is None]
+            new = dict(zip((key for _, key, _, _, _ in stale),
+                render_many(pickle.loads(item) for _, _, _, item, _ in stale)))
+            with self.db:
+                self.db.executemany('insert or replace into outputs values (?, ?, ?, ?)',
+                    ((tag, key, h, new[key]) for _, key, h, _, _ in stale))
+            for _, key, _, _, text in chunk:
+                yield key, new[key] if text is None else text
+
+    def chunks(self, columns, join, params = (), size = 1000):
+        # Yield lists of rows of `items i` (with the position
+        # first), in order. Each chunk is a separate query, so we
+        # can write to the database between chunks.
+        pos = -1
+        while True:
+            chunk = self.db.execute(
+                'select i.pos, {} from items i {} where i.pos > ? order by i.pos limit ?'.format(
+                    columns, join),
+                params + (pos, size)).fetchall()
+            if not chunk:
+                return
+            yield chunk
+            pos = chunk[-1][0]
+
+# ----------------------------------------------------------
+# * Private
+# ----------------------------------------------------------
+
+store_version = 1
+
+schema = '''
+    create table if not exists meta
+       (name text primary key, value text);
+    create table if not exists items
+       (pos integer primary key, key text unique, hash text, item blob);
+    create table if not exists outputs
+       (tag text, key text, hash text, text text,
+        primary key (tag, key));'''
+
+def default_store_path(source_path):
+    return join(
+        environ.get('XDG_CACHE_HOME') or expanduser('~/.cache'),
+        'citematic',
+        sha256(source_path.encode('UTF-8')).hexdigest()[:32] + '.sqlite')
+
+def yaml_load(o):
+    import yaml
+    return yaml.load(o, Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+      # The C loader, if PyYAML has it, is many times faster.
+
+def csl_hash(csl):
+    return sha256(json.dumps(csl, sort_keys = True,
+        ensure_ascii = False, default = str).encode('UTF-8')).hexdigest()
+          # `default` is for dates, which YAML can produce.
@@ -0,0 +1,322 @@
+# Reading RIS into CSL input data, as Citematic::RIS and
+# Citematic::Get::digest_ris do, but lazily, so a big file can go
+# straight to quickbib without ever being held in memory:
+#
+#     quickbib.bib_stream(style_path, citematic_ris.items('dump.ris'))
+#
+# Unlike `digest_ris`, we never go online to look up a missing DOI.
+# Titles are recapitalized with aspell-python's spelling suggestions
+# if it's installed; otherwise, words are simply lowercased.
+
+from html import unescape
+import re
+
+# ----------------------------------------------------------
+# * Public
+# ----------------------------------------------------------
+
+def records(source):
+    """Yield each record in `source` (the path of an RIS file, or
+    an iterable of lines, such as an open file) as a dictionary
+    mapping each tag to the list of its values."""
+    if isinstance(source, str):
+        with open(source, encoding = 'UTF-8-sig', newline = '\n') as o:
+            yield from records(o)
+        return
+    lines = []
+    in_data = False
+    double_newlines = 0
+    for l in source:
+        l = l[:-2] if l.endswith('\r\n') else l[:-1] if l.endswith('\n') else l
+        if '&' in l:
+            l = unescape(l)
+        # Some files have an empty line after every line. We notice
+        # this when the line after "TY" isn't a tag, and then skip
+        # every other line while it's empty.
+        if double_newlines == 1:
+            double_newlines = 2
+        elif double_newlines == 2:
+            if not l:
+                double_newlines = 1
+                continue
+            double_newlines = 0
+        if in_data:
+            if end_tag(l):
+                in_data = False
+                yield record(lines)
+                lines = []
+            elif any_tag(l):
+                lines.append(l)
+            elif lines:
+                if start_tag(lines[-1]):
+                    double_newlines = 1
+                else:
+                    lines[-1] += '\n' + l
+                      # A continuation line.
+        elif start_tag(l):
+            in_data = True
+            lines.append(l)
+    if lines:
+        yield record(lines)
+          # The last record had no "ER".
+
+def items(source, skip_bad = False):
+    """Yield the CSL item for each record of `source`, as for
+    `records`. A record we can't interpret raises ValueError, or,
+    with `skip_bad`, is skipped."""
+    for r in records(source):
+        try:
+            yield csl(r)
+        except ValueError:
+            if not skip_bad:
+                raise
+
+def csl(r):
+    """The CSL item for the record `r`, a dictionary like those
+    from `records`. Only journal articles are supported."""
+    first = lambda *tags: next((r[t][0] for t in tags if t in r), None)
+
+    if first('TY') != 'JOUR':
+        raise ValueError('''Can't handle RIS type "{}"'''.format(first('TY')))
+
+    authors = next((r[t] for t in ('A1', 'AU', 'A2', 'ED', 'A3') if t in r), [])
+    year = re.search(r'\d\d\d\d', first('Y1') or first('PY') or '')
+    if not year:
+        raise ValueError('No year')
+    title = first('TI') or first('T1')
+    journal = digest_journal_title(
+        first('JO') or first('JF') or first('T2') or first('J2') or '')
+    fpage, lpage = (
+        re.split('[-–]', first('SP'))[:2]
+        if first('SP') and re.search('[-–]', first('SP'))
+        else (first('SP'), first('EP')))
+    volume, issue, fpage, lpage = (
+        None if x is None else re.sub(r'\A0+([1-9][0-9]*)\Z', r'\1', x.rstrip())
+        for x in (first('VL') or first('VN'), first('IS') or first('M1'), fpage, lpage))
+
+    doi = first('DO')
+    m3 = first('M3')
+    if not doi and m3 and (m3.startswith('10.') or re.search(r'\bdoi\b', m3)):
+        doi = m3
+    doi = doi and re.search(r'\b(10\.\S+)', doi)
+    doi = doi and doi.group(1)
+
+    url = first('UR')
+    if not (url and re.match(r'http://projecteuclid.org/|https?://www.ncbi.nlm.nih.gov/pmc/', url)):
+      # Keep only URLs of articles that are always open-access.
+        url = None
+
+    return journal_article([digest_author(a) for a in authors], year.group(),
+        title, journal, volume, issue, fpage, lpage, doi, url)
+
+# ----------------------------------------------------------
+# * Private
+# ----------------------------------------------------------
+
+start_tag = re.compile(r'TY  - ?').match
+end_tag = re.compile(r'ER  - ?').match
+any_tag = re.compile(r'\w\w  - ?').match
+tag_value = re.compile(r'(\w\w)  - (.*)\Z', re.DOTALL).match
+
+known_tags = set('''TY ID T1 TI CT BT T2 T3 A1 AU A2 ED A3 Y1 PY Y2 N1 AB N2
+    KW RP JF JO JA J1 J2 VL IS SP EP CP CY PB SN AD AV M1 M2 M3 U1 U2 U3
+    U4 U5 UR L1 L2 L3 L4 ER DO VN'''.split())
+  # The tags Citematic::RIS has accessors for. Others are ignored.
+
+def record(lines):
+    r = {}
+    for l in lines:
+        m = tag_value(l)
+        if m and m.group(1) in known_tags:
+            r.setdefault(m.group(1), []).append(m.group(2))
+    return r
+
+upper = 'A-ZÀ-ÖØ-Þ'
+lower = 'a-zß-öø-ÿ'
+  # Stand-ins for Perl's [[:upper:]] and [[:lower:]], good
+  # enough for names and titles in Latin scripts.
+
+suffix_re = r'(?:Jr\.?|Sr\.?|III\b|IV\b)'
+  # We don't try to capture Roman numerals of V or higher because
+  # otherwise, an initial of V is likely to be mistaken for a suffix.
+
+def digest_author(s):
+    s = re.sub(r'\(.+?\)', '', s)
+    if ',' in s:
+    # We have something of the form "Smith, A. R." or "Smith,
+    # A.R." or "Smith, Allen R." or "Smith, Allen Reginald" or
+    # "Smith, A. Reginald".
+        s = re.sub(r'\.([{}])'.format(upper), r'. \1', s)
+          # Fix initials crammed together without spaces.
+        suffix = {}
+        m = re.search(r',?\s+(' + suffix_re + ')', s)
+        if m:
+            suffix = dict(suffix = format_suffix(m.group(1)))
+            s = s[:m.start()] + s[m.end():]
+        m = re.match(r'(.+?),\s*(.+?)(?:<|,|\Z)', s, re.DOTALL)
+        if not m:
+            raise ValueError('Bad author: ' + s)
+        surname, rest = m.groups()
+        if not re.search('[{}]'.format(lower), re.sub(r'\Ama?c', '', surname, flags = re.I)):
+            surname = fix_allcaps_name(surname)
+        rest = re.sub(r'\b([{}])( |\Z)'.format(upper), r'\1.\2', rest)
+          # Add periods after initials, if necessary.
+        return dict(family = surname, given = rest, **suffix)
+    m = re.search(r'\s+([{0}]+)\s*({1}?)\Z'.format(upper, suffix_re), s)
+    if m and re.search(r'[{}]\s+[{}]{{1,4}}(?:\s+{})?\Z'.format(lower, upper, suffix_re), s):
+    # We have something of the form "Smith AR".
+        d = dict(family = s[:m.start()],
+            given = ' '.join(c + '.' for c in m.group(1)))
+        if m.group(2):
+            d['suffix'] = format_suffix(m.group(2))
+        return d
+    # We have something of the form "Allen R. Smith".
+    if re.search('[{}]{{5}}'.format(upper), s):
+        s = ' '.join(map(fix_allcaps_name, s.split(' ')))
+    ws = s.split()
+    for i in range(len(ws) - 1):
+    # End the given name once the current word has a period and
+    # the next doesn't. Otherwise, treat the last word as the
+    # surname and the rest as given.
+        if ws[i].endswith('.') and not ws[i + 1].endswith('.'):
+            break
+    else:
+        i = len(ws) - 2
+    return dict(family = ' '.join(ws[i + 1:]), given = ' '.join(ws[:i + 1]))
+
+def fix_allcaps_name(name):
+    prefix = ''
+    for p in ('Mc', 'Mac'):
+        if name.startswith(p):
+            prefix, name = p, name[len(p):]
+    name = name.lower()
+    name = name[:1].upper() + name[1:]
+    return prefix + re.sub(r'-(\w)', lambda m: '-' + m.group(1).upper(), name)
+
+def format_suffix(s):
+    s = re.sub(r'\A([SJ]r)\.?', r'\1.', s)
+    return dict([('1st', 'I'), ('2nd', 'II'), ('3rd', 'III')]).get(s, s)
+
+small_words = re.compile(r'\b(An|And|As|At|But|By|Down|For|From|In|Into|Nor|Of|On|Onto|Or|Over|So|The|Till|To|Up|Via|With|Yet)\b')
+
+def digest_journal_title(j):
+    j = re.sub(r'\AThe ', '', j)
+    j = re.sub(r'\s*\([^)]+\)\s*\Z', '', j)
+    j = re.sub(r' = .+', '', j)
+
+    if re.search('Proceedings of the National Academy of Sciences of the United States of America', j, re.I):
+        return 'Proceedings of the National Academy of Sciences'
+    if j == 'Proceedings. Biological Sciences':
+        return 'Proceedings of the Royal Society B'
+    m = re.search(r'Philosophical Transactions of the Royal Society of London\. Series ([AB])', j, re.I)
+    if m:
+        return 'Philosophical Transactions of the Royal Society ' + m.group(1)
+    if re.search(r'Journals of Gerontology\W+Series B', j, re.I):
+        return 'The Journals of Gerontology, Series B: Psychological Sciences and Social Sciences'
+    if re.search('IEEE Transactions on Systems', j, re.I):
+        return 'IEEE Transactions on Systems, Man, and Cybernetics'
+    if ', IEEE Transactions on' in j:
+        return 'IEEE Transactions on ' + j.replace(', IEEE Transactions on', '', 1)
+    if j == 'American Statistician':
+        return 'The American Statistician'
+    if re.search('ANNALS of the American Academy of Political and Social Science', j, re.I):
+        return 'The ANNALS of the American Academy of Political and Social Science'
+    if re.match(r'Journal of Psychology(?:\Z|:)', j, re.I):
+        return 'The Journal of Psychology: Interdisciplinary and Applied'
+    if re.search('PLOS ONE', j, re.I):
+        return 'PLOS ONE'
+
+    if re.search(r'Memory (?:and|&) Cognition|Psychology (?:and|&) Health', j, re.I):
+        j = j.replace('and', '&', 1)
+    else:
+        j = j.replace('&', 'and', 1)
+    j = re.sub(r'(\A| )(\w)', lambda m: m.group(1) + m.group(2).upper(), j)
+    j = small_words.sub(lambda m: m.group(1)[0].lower() + m.group(1)[1:], j)
+    if re.match(r'Journal of Experimental Psychology|American Economic Journal', j, re.I):
+        j = j.replace('.', ':', 1)
+    else:
+        j = re.sub(r'\s*[/:.].+', '', j, count = 1, flags = re.DOTALL)
+    return j
+
+def journal_article(authors, year, title, journal, volume, issue,
+        first_page, last_page, doi, url):
+    title = format_nonjournal_title(title or '')
+    if issue is not None:
+        issue = re.sub(r'Suppl\.?(?:ement)?', 'Suppl.', issue, count = 1)
+        m = re.match(r'(\d+)-(\d+)\Z', issue)
+        if m and int(m.group(2)) == int(m.group(1)) + 1:
+            issue = '{}, {}'.format(*m.groups())
+        issue = re.sub(r'p\d.*', '', issue, count = 1, flags = re.DOTALL)
+    if journal.startswith('The Journals of Gerontology') and volume:
+        volume = re.sub('[A-Z]\\Z', '', volume)
+    if journal == 'PLOS ONE' or journal.startswith('Cochrane Database'):
+      # We don't need all this stuff for a purely electronic journal.
+        volume = issue = first_page = last_page = None
+    return citation(
+        type = 'article-journal',
+        author = authors,
+        issued = {'date-parts': [[year]]},
+        title = title,
+        **{'container-title': journal},
+        volume = volume,
+        issue = issue,
+        page = '{}–{}'.format(first_page, last_page) if last_page else first_page,
+        DOI = doi,
+        URL = url)
+
+def citation(**fields):
+    return {k: v.translate(plain_quotes) if isinstance(v, str) else v
+        for k, v in fields.items()
+        if v is not None}
+
+plain_quotes = str.maketrans('‘’“”', "''\"\"")
+
+def format_nonjournal_title(s):
+    s = s.replace('\xa0', ' ')
+      # Nonbreaking spaces.
+    s = s.lstrip()
+    if ' ' in s and (len(re.findall(r'\b[{}]'.format(upper), s)) /
+            max(1, len(re.findall(r'\b[^\W\d_]', s)))) > 1/2:
+    # The title is probably miscapitalized, but we'll try to fix it.
+        if re.search('[{}]'.format(lower), s):
+        # The Title Is Probably Capitalized Like This.
+            s = re.sub('''(?<=[- ('‘"“])([{}])([^-. ()'‘’"“’]+)'''.format(upper),
+                lambda m: respell(m.group(1).lower() + m.group(2)), s)
+            s = re.sub(r'([^\W\d_])', lambda m: m.group(1).upper(), s, count = 1)
+              # Make sure the first letter is capitalized.
+        else:
+        # THE TITLE IS IN ALL CAPS.
+            s = re.sub(r'[^- .?!]+', lambda m: respell(m.group().lower()), s)
+            s = s[:1].upper() + s[1:]
+        s = re.sub(r'\b(i{1,3}|iv|v|vi{1,3}|ix)\b', lambda m: m.group(1).upper(), s,
+            flags = re.I)
+          # Roman numerals.
+    s = re.sub(r'\s*([:?])\W+(\w)', lambda m: m.group(1) + ' ' + m.group(2).upper(), s)
+      # Insert a space and capitalize after (but remove spaces
+      # before) colons and question marks.
+    if "'" in s:
+        s = re.sub(r"`([^`']+)'", r'"\1"', s)
+          # GNU-style single quotes that should be double quotes.
+        s = re.sub(r"(\W|\A)'([^`' ][^`']*[^`' ])'(\W|\Z)", r'\1"\2"\3', s)
+          # Matched single quotes that should be double quotes.
+    s = s.replace('...', '…')
+    if '…' in s:
+        s = re.sub(r'(\w)\s*…', r'\1…', s)
+        s = re.sub(r'…(\w)', r'… \1', s)
+    return s.rstrip('.')
+
+def respell(word):
+    # `word`, or the spelling checker's capitalization of it, if
+    # that's the only difference (as for a proper noun).
+    if speller is None or speller.check(word):
+        return word
+    suggestions = speller.suggest(word)
+    return (suggestions[0]
+        if suggestions and suggestions[0].lower() == word.lower()
+        else word)
+
+try:
+    import aspell
+    speller = aspell.Speller('lang', 'en')
+except Exception:
+    speller = None
@@ -1,25 +1,39 @@
 #!/usr/bin/env python3
 
-from sys import stderr
+from sys import stdout, stderr
 from os import environ
-import yaml, cgi
-from citematic_coins import coins
+from time import monotonic
+import html
+from citematic_coins import coins_many
+from citematic_db import Database
 
-bib_path = environ['DAYLIGHT_BIB_PATH']
+database = Database(environ['DAYLIGHT_BIB_PATH'])
+  # Only entries that are new or changed since the last run
+  # get new COinS.
 
-with open(bib_path) as o:
-    database = yaml.load(o)
+done, last = 0, None
+def progress(items, every = 1):
+    # Yield the items, reporting our progress at most once per
+    # `every` seconds.
+    global done, last
+    for x in items:
+        done += 1
+        if last is None or monotonic() - last >= every:
+            print('{} of at most {} ({})…'.format(done, len(database), x['KEY']), file = stderr)
+            last = monotonic()
+        yield x
 
-print('''<!DOCTYPE html>
+stdout.write('''<!DOCTYPE html>
 
 <html lang="en-US">
 <head>
    <meta charset="UTF-8">
-   <title>Bibliography in COinS</title>   
+   <title>Bibliography in COinS</title>
 </head>
 
-<body>''')
-for n, x in enumerate(database):
-    print('{} of {} ({})…'.format(n + 1, len(database), x['KEY']), file = stderr)
-    print('<p>{}: {}\n'.format(cgi.escape(x['KEY']), coins(x['csl'])))
-print('</body></html>')
+<body>
+''')
+for key, span in database.outputs('coins',
+        lambda items: coins_many(x['csl'] for x in progress(items))):
+    stdout.write('<p>{}: {}\n\n'.format(html.escape(key, quote = False), span))
+stdout.write('</body></html>\n')
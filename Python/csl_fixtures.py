@@ -0,0 +1,27 @@
+# -*- Python -*-
+#
+# CSL items shared by the tests and the benchmarks.
+
+from quickbib import name
+
+def merge_dicts(d1, d2):
+    return dict(list(d1.items()) + list(d2.items()))
+
+def dashed(d):
+    # Spell the keys of `d` as CSL does, with hyphens instead of
+    # underscores, and drop the fields that are None.
+    return {k.replace('_', '-'): v for k, v in d.items() if v is not None}
+
+def jf(**field_kws):
+    return merge_dicts(
+        dict(type = 'article-journal',
+            author =
+                [name('Joesph', 'Bloggs'),
+                name('J. Random', 'Hacker')],
+            issued = {'date-parts': [[1983]]},
+            title = 'The main title',
+            container_title = 'Sciency Times',
+            volume = '30', issue = '7',
+            page = '293–315',
+            DOI = '10.zzz/zzzzzz'),
+        field_kws)
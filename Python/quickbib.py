@@ -1,17 +1,27 @@
 from sys import stdin, stdout, argv
+from os import environ, stat, makedirs, unlink
+from os.path import dirname, abspath
 from string import ascii_lowercase
-from re import sub, DOTALL
+from re import sub, compile, DOTALL, MULTILINE, IGNORECASE
+from unicodedata import normalize, combining
 from io import StringIO
-from collections import defaultdict
+from hashlib import sha256
+from collections import defaultdict, OrderedDict
+from bisect import insort, bisect_left
+from functools import partial
+from itertools import count, islice, groupby, chain
+from operator import itemgetter
+from heapq import merge
+from importlib import import_module
 from copy import deepcopy
-from random import random
-import json
+from time import perf_counter
+from contextlib import contextmanager, nullcontext
+from threading import Lock, Thread
+import json, pickle
 
-from citeproc import CitationStylesStyle, CitationStylesBibliography
-from citeproc.source import Citation, CitationItem
-from citeproc.source.json import CiteProcJSON
-import citeproc.formatter.plain
-import citeproc.formatter.html
+# citeproc-py, the formatters, and other modules that only some
+# calls need are imported on first use, so that starting up is
+# quick. See `load_citeproc`.
 
 # ------------------------------------------------------------
 # Public
@@ -22,6 +32,16 @@ def name(given, family, suffix = None):
     if suffix is not None: n['suffix'] = suffix
     return n
 
+def preload(style_paths = ()):
+    """Import everything that rendering needs, and load the given
+    styles (with the default options), so the first call of `bib`
+    needn't wait for that."""
+    load_citeproc()
+    for k in formatters:
+        get_formatter(k)
+    for p in style_paths:
+        get_style(p, True, False, False, True)
+
 def bib1(style_path, d, **rest):
     return bib(style_path, [d], **rest)[0]
 
@@ -35,138 +55,787 @@ def bib(style_path,
         include_isbn = False,
         url_after_doi = False,
         publisher_website = True,
-        abbreviate_given_names = True):
+        abbreviate_given_names = True,
+        # How to compare names and titles; see `get_collation`.
+        collation = None,
+        # Render each set of duplicate items (see `duplicates`,
+        # which also says which items were merged) as one entry.
+        dedup = False,
+        # Render entries in this many processes.
+        workers = None,
+        # A Stats object to record timings in.
+        stats = None):
 
-    if isinstance(formatter, str):
-        try:             formatter = formatter_from_name[formatter]
-        except KeyError: raise ValueError('Unknown formatter "{}"'.format(formatter))        
+    stats = stats or default_stats or no_stats
+    formatter = get_formatter(formatter)
+    fold = get_collation(collation)
+    with stats.phase('style'):
+        style = get_style(style_path, apa_tweaks,
+            include_isbn, url_after_doi, abbreviate_given_names, stats)
+
+    options = (apa_tweaks, always_include_issue, publisher_website,
+        abbreviate_given_names)
+    items, firsts = prepare(ds, options, fold, stats, dedup)
+
+    if style.independent:
+    # We can render (or look up) each entry on its own.
+        return assemble(render_items(style, formatter, items, apa_tweaks, workers, stats),
+            items, firsts, return_cites_and_keys, stats)
+    return bib_together(style, formatter, items, firsts, apa_tweaks,
+        return_cites_and_keys, stats)
+
+def bib_multi(ds,
+        targets,
+        collation = None,
+        dedup = False,
+        workers = None,
+        stats = None):
+    """Render the same CSL items for several styles, formatters,
+    or sets of options at once. `targets` is a list of triples
+    `(style_path, formatter, options)`, where `options` is a
+    dictionary of other keyword arguments for `bib`, or a
+    dictionary whose values are such triples. The result is a
+    list or dictionary, respectively, of what `bib` would return
+    for each target.
+
+    IDs, sort keys, and year suffixes are worked out only once.
+    With `workers`, the entries of all the targets whose entries
+    are independent are rendered on the same pool of processes,
+    all at once."""
+
+    stats = stats or default_stats or no_stats
+    fold = get_collation(collation)
+    names = list(targets) if isinstance(targets, dict) else None
+    targets = [
+        dict(options, style_path = style_path, formatter = formatter)
+        for style_path, formatter, options in
+            (targets.values() if names is not None else targets)]
+    for t in targets:
+        for k in t:
+            if k not in target_options:
+                raise TypeError('bib_multi: unexpected option ' + repr(k))
+
+    items, firsts = prepare(ds, (False, False, False, False), fold, stats, dedup)
+      # Without `apa_tweaks`, `tweak` only drops None values, but
+      # that's all that matters for sort keys.
+    if any(t.get('apa_tweaks', True) for t in targets):
+        add_year_suffixes(items, stats)
+
+    jobs = []
+    for t in targets:
+        t['formatter'] = get_formatter(t.get('formatter', 'chocolate'))
+        t.setdefault('apa_tweaks', True)
+        t.setdefault('abbreviate_given_names', True)
+        with stats.phase('style'):
+            t['style'] = get_style(t['style_path'], t['apa_tweaks'],
+                t.get('include_isbn', False), t.get('url_after_doi', False),
+                t['abbreviate_given_names'], stats)
+        options = (t['apa_tweaks'], t.get('always_include_issue', False),
+            t.get('publisher_website', True), t['abbreviate_given_names'])
+        t['items'] = [it.retarget(options, t['apa_tweaks']) for it in items]
+        if t['style'].independent:
+            jobs.append((t['style'], t['formatter'], t['items'], t['apa_tweaks']))
+
+    rendered = iter(render_many(jobs, workers, stats))
+    results = [
+        assemble(next(rendered), t['items'], firsts,
+                t.get('return_cites_and_keys', False), stats)
+            if t['style'].independent else
+        bib_together(t['style'], t['formatter'], t['items'], firsts,
+            t['apa_tweaks'], t.get('return_cites_and_keys', False), stats)
+        for t in targets]
+    return results if names is None else dict(zip(names, results))
+
+def cites(style_path,
+        ds,
+        formatter = "chocolate",
+        apa_tweaks = True,
+        always_include_issue = False,
+        include_isbn = False,
+        url_after_doi = False,
+        publisher_website = True,
+        abbreviate_given_names = True,
+        collation = None,
+        dedup = False,
+        stats = None):
+    """Return the inline citations and the keys that `bib` would
+    with `return_cites_and_keys`, but without rendering the entries.
+    If the style's entries are independent, citations are also
+    memoized in `cite_cache`, so calling this again as a document
+    changes is quick."""
+
+    stats = stats or default_stats or no_stats
+    formatter = get_formatter(formatter)
+    fold = get_collation(collation)
+    with stats.phase('style'):
+        style = get_style(style_path, apa_tweaks,
+            include_isbn, url_after_doi, abbreviate_given_names, stats)
+    options = (apa_tweaks, always_include_issue, publisher_website,
+        abbreviate_given_names)
+    items, firsts = prepare(ds, options, fold, stats, dedup)
+
+    if style.independent:
+        cited = cite_items(style, formatter, items, apa_tweaks, stats)
+        keys = list(cited)
+        if len(items) > 1:
+            with stats.phase('sorting', len(keys)):
+                keys.sort(key = lambda k: firsts[k].sort_key)
+        return [cited[it.key] for it in items], keys
+
+    with get_renderer(style, formatter) as r:
+        with stats.phase('registration', len(items)):
+            citations = r.reset([it.csl() for it in items])
+        if len(items) > 1:
+            with stats.phase('sorting', len(items)):
+                sort_bibliography(r.bibliography, firsts)
+        with stats.phase('citations', len(citations)):
+            return ([r.bibliography.cite(c, lambda x: None) for c in citations],
+                r.bibliography.keys)
+
+def duplicates(ds, collation = None):
+    """Return a list of lists of the positions in `ds` of CSL
+    items that are the same work, for each work that appears
+    more than once. Items are the same work if they have the
+    same ID, DOI, or (for books) ISBN, or the same authors'
+    surnames, year, and title, as compared by `collation`;
+    but items with different DOIs never are. With `dedup`, `bib`
+    renders each such list as just its first item."""
+    return duplicate_groups([(item_id(d), d) for d in ds],
+        get_collation(collation))
+
+def bib_stream(style_path,
+        ds,
+        formatter = "chocolate",
+        apa_tweaks = True,
+        always_include_issue = False,
+        include_isbn = False,
+        url_after_doi = False,
+        publisher_website = True,
+        abbreviate_given_names = True,
+        collation = None,
+        chunk_size = 10000,
+        workers = None):
+    """Like `bib`, but for collections too big to hold in memory.
+
+    `ds` is an iterable of CSL items or the path of a file with
+    one JSON item per line (or, if the name ends with ".ris", an
+    RIS file, read with `citematic_ris.items`). Entries are yielded
+    in order. No more
+    than about `chunk_size` items are held in memory at once; the
+    rest are spilled to temporary files and merged. If the same
+    ID appears more than once, only the last such item is used, as
+    with `bib`.
 
+    `collation` and `workers` are as for `bib`. Styles whose
+    entries depend on each other can't be streamed, so for those,
+    this just calls `bib`."""
+
+    formatter = get_formatter(formatter)
+    fold = get_collation(collation)
     style = get_style(style_path, apa_tweaks,
         include_isbn, url_after_doi, abbreviate_given_names)
 
-    ds = deepcopy(ds)
-    ds_by_id = defaultdict(list)
+    if isinstance(ds, str):
+        ds = (import_module('citematic_ris').items(ds)
+            if ds.lower().endswith('.ris')
+            else read_json_lines(ds))
 
-    for d in ds:
-        if 'id' not in d:
-            d['id'] = str(random())
-        ds_by_id[d['id']].append(d)
+    if not style.independent:
+        yield from bib(style_path, list(ds), formatter = formatter,
+            apa_tweaks = apa_tweaks,
+            always_include_issue = always_include_issue,
+            include_isbn = include_isbn, url_after_doi = url_after_doi,
+            publisher_website = publisher_website,
+            abbreviate_given_names = abbreviate_given_names,
+            collation = collation)
+        return
+
+    def numbered():
+        for serial, d in enumerate(ds):
+            if 'id' not in d:
+                d = dict(d, id = item_id(d, serial))
+            yield ((citeproc_key(d), serial), (serial, d))
+
+    def distinct():
+        # Sort by ID to drop duplicates. Each ID keeps the place of
+        # its first item but takes the contents of its last.
+        for _, group in groupby(external_sort(numbered(), chunk_size),
+                key = lambda r: r[0][0]):
+            _, (serial, d) = next(group)
+            for _, (_, d) in group:
+                pass
+            yield serial, d
+
+    def prepared():
+        for serial, d in distinct():
+            p = tweak(d, {}, apa_tweaks, always_include_issue,
+                publisher_website, abbreviate_given_names)
+            yield serial, d, p, sort_key(p, fold)
+
+    def suffixed():
+        # Sort by author and year (and then title) so each group
+        # of works needing year suffixes comes out together.
+        for _, group in groupby(
+                external_sort(
+                    (((author_year_key(d), key[2], serial), (serial, p, key))
+                        for serial, d, p, key in prepared()),
+                    chunk_size),
+                key = lambda r: r[0][0]):
+            group = [r[1] for r in group]
+            for i, (serial, p, key) in enumerate(group):
+                if len(group) > 1:
+                    p = dict(p, year_suffix = suffix_letters(i))
+                yield serial, p, key
+
+    def rendered():
+        for chunk in chunks(suffixed() if apa_tweaks else
+                ((serial, p, key) for serial, _, p, key in prepared()),
+                chunk_size):
+            r = render_items(style, formatter, [Item(p) for _, p, _ in chunk],
+                apa_tweaks, workers)
+            for serial, p, key in chunk:
+                entry, _ = r[citeproc_key(p)]
+                if entry is not None:
+                    yield ((key, serial), entry)
+
+    for _, entry in external_sort(rendered(), chunk_size):
+        yield entry
+
+def bib_each(style_path,
+        ds,
+        formatter = "chocolate",
+        apa_tweaks = True,
+        always_include_issue = False,
+        include_isbn = False,
+        url_after_doi = False,
+        publisher_website = True,
+        abbreviate_given_names = True,
+        collation = None,
+        dedup = False,
+        workers = None,
+          # These three are accepted for the sake of `batch`, but
+          # single entries have nothing to sort or merge, and
+          # aren't worth sending to another process.
+        stats = None):
+    # Equivalent to `[bib1(style_path, d, ...) for d in ds]`, but
+    # the style and formatter are looked up once and, when the
+    # style allows, all the items are rendered in one pass.
+
+    stats = stats or default_stats or no_stats
+    formatter = get_formatter(formatter)
+    with stats.phase('style'):
+        style = get_style(style_path, apa_tweaks,
+            include_isbn, url_after_doi, abbreviate_given_names, stats)
+    options = dict(apa_tweaks = apa_tweaks,
+        always_include_issue = always_include_issue,
+        include_isbn = include_isbn, url_after_doi = url_after_doi,
+        publisher_website = publisher_website,
+        abbreviate_given_names = abbreviate_given_names)
+
+    if not style.independent:
+        return [bib1(style_path, d, formatter = formatter, stats = stats, **options)
+            for d in ds]
+
+    items = [
+        Item(d, str(i), (apa_tweaks, always_include_issue,
+            publisher_website, abbreviate_given_names))
+        for i, d in enumerate(ds)]
+      # The items are separate bibliographies, so we replace their
+      # IDs, which could collide.
+    rendered = render_items(style, formatter, items, apa_tweaks, stats = stats)
+    return [rendered[it.key][0] for it in items]
+
+def batch(jobs, stats = None):
+    """Carry out a list of independent IPC jobs (each a dictionary
+    with "command" "bib1" or "bib" and "args") and return a
+    list of replies, each with either a "value" or an "error".
+
+    "bib1" jobs that share a style and options are rendered
+    together with `bib_each`. Timings for all the jobs go into
+    `stats`."""
+
+    stats = stats or no_stats
+    replies = [None] * len(jobs)
+    groups = defaultdict(list)
+    for i, job in enumerate(jobs):
+        try:
+            if job['command'] == 'bib1' and not job['args'].get('return_cites_and_keys'):
+                groups[json.dumps({k: v for k, v in job['args'].items()
+                        if k not in ('d', 'return_cites_and_keys')},
+                    sort_keys = True)].append(i)
+                continue
+        except Exception:
+            pass
+              # A malformed job gets its error from `handle`.
+        replies[i] = handle(job, stats)
+
+    for ixs in groups.values():
+        args = dict(jobs[ixs[0]]['args'])
+        try:
+            args['ds'] = [jobs[i]['args']['d'] for i in ixs]
+            del args['d']
+            args.pop('return_cites_and_keys', None)
+            for i, entry in zip(ixs, bib_each(stats = stats, **args)):
+                replies[i] = {'value': entry}
+        except Exception:
+        # Try each job on its own, so the error goes with the
+        # job that caused it.
+            for i in ixs:
+                replies[i] = handle(jobs[i], stats)
+
+    return replies
+
+def register_rules(name, rules, style_ids = ()):
+    """Add or replace the set of post-processing rules called
+    `name`, and use it instead of the APA rules, when
+    `apa_tweaks` is on, for styles whose CSL IDs are in
+    `style_ids`.
+
+    Each rule is a pair of a regular expression and its
+    replacement, as for `re.sub`, or a triple that adds a list
+    of the formatters (by name) it applies to. The rules run in
+    order over each rendered entry. They may be run over many
+    entries joined by newlines, so they shouldn't match newlines;
+    `^` and `$` match at the ends of each entry. The built-in
+    sets are `basic_rules` and `apa_rules`."""
+    rule_sets[name] = list(rules)
+    for style_id in style_ids:
+        style_rule_sets[style_id] = name
+    compiled_rules.clear()
+
+class YearSuffixes(object):
+    """An index of works by author and year, for telling apart
+    works with the same authors and year by adding suffixes to
+    the year ("1983a", "1983b", …, "1983z", "1983aa", …), in
+    order of title. It can be updated incrementally; `add` and
+    `remove` return the set of IDs whose suffixes may have
+    changed."""
+
+    def __init__(self):
+        self.groups = {}
+          # Maps author-year keys to sorted lists of (title key,
+          # serial number, ID) triples.
+        self.where = {}
+          # Maps IDs to (author-year key, triple) pairs.
+        self.next_serial = count()
+
+    def __contains__(self, d_id):
+        return d_id in self.where
+
+    def add(self, items, serials = None):
+        # `items` is an iterable of triples of an ID, a CSL item,
+        # and its `sort_key`. IDs already in the index are
+        # skipped. Works with the same title are ordered by
+        # `serials[ID]`, if provided, or else the order they were
+        # added in. The returned set includes the new IDs.
+        new = defaultdict(list)
+        for d_id, d, key in items:
+            if d_id in self.where:
+                continue
+            k = author_year_key(d)
+            e = (key[2],
+                next(self.next_serial) if serials is None else serials[d_id],
+                d_id)
+            self.where[d_id] = (k, e)
+            new[k].append(e)
+        changed = set()
+        for k, es in new.items():
+            group = self.groups.setdefault(k, [])
+            i = 0 if len(group) < 2 else bisect_left(group, min(es))
+            group.extend(es)
+            group.sort()
+            changed.update(e[2] for e in group[i:])
+        return changed
+
+    def remove(self, d_ids):
+        changed = set()
+        for d_id in d_ids:
+            k, e = self.where.pop(d_id)
+            group = self.groups[k]
+            i = bisect_left(group, e)
+            del group[i]
+            changed.update(e[2] for e in group[0 if len(group) < 2 else i:])
+            if not group:
+                del self.groups[k]
+        return {d_id for d_id in changed if d_id in self.where}
+
+    def suffix(self, d_id):
+        k, e = self.where[d_id]
+        group = self.groups[k]
+        return suffix_letters(bisect_left(group, e)) if len(group) > 1 else None
+
+    def suffixes(self):
+        # Return a dictionary mapping the ID of each work that
+        # needs a suffix to its suffix.
+        return {e[2]: suffix_letters(i)
+            for group in self.groups.values() if len(group) > 1
+            for i, e in enumerate(group)}
+
+class Bibliography(object):
+    """A bibliography that can be edited one item at a time.
+
+    The constructor takes the same arguments as `bib` (except
+    for `return_cites_and_keys`). Each of `add`, `update`, and
+    `remove` returns a dictionary mapping the ID of every item
+    whose entry changed to its new entry, or to None for items
+    that were removed. Only the edited items, and items whose
+    year suffixes changed as a result, are re-rendered."""
+
+    def __init__(self, style_path, ds = (), formatter = "chocolate",
+            apa_tweaks = True, **options):
+        self.style_path = style_path
+        self.options = dict(options,
+            formatter = get_formatter(formatter), apa_tweaks = apa_tweaks)
+        self.fold = get_collation(options.get('collation'))
+        self.style = get_style(style_path, apa_tweaks,
+            options.get('include_isbn', False),
+            options.get('url_after_doi', False),
+            options.get('abbreviate_given_names', True))
+        self.items = {}
+          # Maps IDs to (copies of) the CSL items.
+        self.index = YearSuffixes()
+        self.suffixes = {}
+        self.entries = {}
+        self.sort_keys = {}
+        self.order = []
+          # A sorted list of (sort key, serial number, ID)
+          # triples. The serial number, which is assigned when
+          # an item is first added, preserves input order among
+          # items that sort the same, as in `bib`.
+        self.serials = {}
+        self.next_serial = count()
+        self.edit(ds, ())
+
+    def add(self, d):
+        return self.edit([d], ())
+
+    def update(self, d):
+        if d.get('id') not in self.items:
+            raise KeyError(d.get('id'))
+        return self.edit([d], ())
+
+    def remove(self, d_id):
+        if d_id not in self.items:
+            raise KeyError(d_id)
+        return self.edit((), [d_id])
+
+    def keys(self):
+        return [d_id for _, _, d_id in self.order]
+
+    def bibliography(self):
+        return [self.entries[d_id] for _, _, d_id in self.order]
+
+    def edit(self, new, removed):
+        apa_tweaks = self.options['apa_tweaks']
+        dirty = {}
+
+        for d_id in removed:
+            del self.items[d_id]
+        for d in new:
+            d = deepcopy(d)
+            if 'id' not in d:
+                d['id'] = item_id(d)
+            if d['id'] not in self.items:
+                self.serials[d['id']] = next(self.next_serial)
+            self.items[d['id']] = d
+            dirty[d['id']] = True
+        new_keys = {d_id: sort_key(self.prepared(self.items[d_id]), self.fold)
+            for d_id in dirty}
 
-    if apa_tweaks:
-    # Distinguish entries that would have identical authors and years
-    # by adding suffixes to the years.
-        # Group works by author and year.
-        #
-        # (Actually, we use only an initial subset of authors,
-        # the same number that would be included in an inline citation
-        # after the first inline citation. This is 2 for 2 authors
-        # and 1 otherwise. For 3 or more authors, we also add a cookie
-        # for "et al.".)
-        ay = defaultdict(list)
-        for d in ds:
-            names = d.get('author') or d.get('editor')
-            names = [names[0]] + (
-                []         if len(names) == 1 else
-                [names[1]] if len(names) == 2 else
-                ['etal'])
-            k = repr(names) + '/' + str(d['issued']['date-parts'][0][0])
-            if d['id'] not in ay[k]:
-                ay[k].append(d['id'])
-        # If any group has more than one element, add suffixes.
-        for v in ay.values():
-            if len(v) > 1:
-                for i, d_id in enumerate(sorted(v, key = lambda d_id:
-                       title_sort_key(ds_by_id[d_id][0]))):
-                   for d in ds_by_id[d_id]:
-                       d['year_suffix'] = ascii_lowercase[i]
-
-    for d in ds:
-        for k in list(d.keys()):
-            if d[k] is None: del d[k]
-        if apa_tweaks:
-            # By default, don't include the issue number for
-            # journal articles.
-            if not always_include_issue and d['type'] == 'article-journal':
-                delf(d, 'issue')
-            # Use the weird "Retrieved from Dewey, Cheatem, &
-            # Howe website: http://example.com" format prescribed
-            # for reports.
-            if publisher_website and d['type'] == 'report' and 'publisher' in d and 'URL' in d:
-                d['URL'] = '{} website: {}'.format(
-                    d.pop('publisher'), d['URL'])
-            # Add structure words for presentations and include
-            # the event place.
-            if d['type'] == 'speech' and d['genre'] == 'paper':
-                d['event'] = 'meeting of the {}, {}'.format(
-                    d.pop('publisher'), d['event-place'])
-            if d['type'] == 'speech' and d['genre'] == 'video':
-                d['medium'] = 'Video file'
-                del d['genre']
-            # Format encyclopedia entries like book chapters.
-            if d['type'] == 'entry-encyclopedia':
-                d['type'] = 'chapter'
-            # When abbreviating given names, remove hyphens
-            # preceding lowercase letters. Otherwise, weird
-            # stuff happens.
-            if abbreviate_given_names and 'author' in d:
-               for a in d['author']:
-                   if 'given' in a:
-                       a['given'] = sub(
-                           '-(.)',
-                           lambda mo:
-                               ("" if mo.group(1).islower() else "-") +
-                               mo.group(1),
-                           a['given'])
-
-    bibliography = CitationStylesBibliography(
-        style,
-        CiteProcJSON(ds),
-        formatter)
-    cites = [ Citation([CitationItem(d['id'])]) for d in ds ]
-    for c in cites: bibliography.register(c)
-    def sort_key_f(item):
-        ref = item.reference
-        names = [(name['family'].lower(), name['given'][0].lower() if 'given' in name else '')
-            for name in ref.get('author') or ref.get('editor')]
-        return (names, ref['issued']['year'],
-            title_sort_key(ref),
-            ref['page']['first'] if 'page' in ref else '')
-    if len(ds) > 1:
-        # Sort the bibliography
-        # bibliography.sort()   # Doesn't appear to handle leading "the"s correctly.
-        bibliography.items = sorted(bibliography.items, key = sort_key_f)
-        bibliography.keys = [item.key for item in bibliography.items]
-    bibl = bibliography.bibliography()
-
-    for i, s in enumerate(bibl):
-        s = ''.join(s)
-        # Fix spacing and punctuation issues.
-        s = s.replace('  ', ' ')
-        s = sub(r'([.!?…])\.', r'\1', s)
         if apa_tweaks:
-            if formatter is citeproc.formatter.html or formatter is chocolate:
-                # Italicize the stuff between a journal name and a volume
-                # number.
-                s = sub(r'</i>, <i>(\d)', r', \1', s)
-                # Remove redundant periods that are separated
-                # from the first end-of-sentence mark by an </i>
-                # tag.
-                s = sub(r'([.!?…]</i>)\.', r'\1', s)
-            # If there are two authors and the first is a mononym,
-            # remove the comma after it.
-            s = sub('^([^.,]+), &', r'\1 &', s)
-        bibl[i] = s
+        # Reassign year suffixes. Every item whose suffix changes
+        # has to be re-rendered.
+            touched = self.index.remove(
+                [d_id for d_id in chain(removed, dirty) if d_id in self.index])
+            touched |= self.index.add(
+                ((d_id, self.items[d_id], new_keys[d_id]) for d_id in new_keys),
+                self.serials)
+            for d_id in touched:
+                if d_id in self.items:
+                    suffix = self.index.suffix(d_id)
+                    if suffix != self.suffixes.get(d_id):
+                        dirty[d_id] = True
+                        delf(self.suffixes, d_id)
+                        if suffix is not None:
+                            self.suffixes[d_id] = suffix
 
-    if return_cites_and_keys:
-        fcites = [bibliography.cite(c, lambda x: None) for c in cites]
-        return (fcites, bibliography.keys, bibl)
-    else:
-        return bibl
+        diff = {}
+        for d_id in removed:
+            self.unorder(d_id)
+            del self.entries[d_id], self.sort_keys[d_id], self.serials[d_id]
+            delf(self.suffixes, d_id)
+            diff[d_id] = None
+
+        if self.style.independent:
+            rendered = (
+                (d_id, new_keys[d_id] if d_id in new_keys else self.sort_keys[d_id],
+                    self.render1(self.items[d_id]))
+                for d_id in dirty)
+        else:
+        # Entries can depend on one another (through citation
+        # numbers, say), so re-render everything.
+            rendered = self.render_all()
+        for d_id, key, entry in rendered:
+            if d_id in self.entries:
+                self.unorder(d_id)
+            self.sort_keys[d_id] = key
+            insort(self.order, (key, self.serials[d_id], d_id))
+            if self.entries.get(d_id) != entry:
+                diff[d_id] = self.entries[d_id] = entry
+        return diff
+
+    def unorder(self, d_id):
+        i = bisect_left(self.order,
+            (self.sort_keys[d_id], self.serials[d_id], d_id))
+        del self.order[i]
+
+    def prepared(self, d):
+        return tweak(d,
+            {'year_suffix': self.suffixes[d['id']]}
+                if d['id'] in self.suffixes else {},
+            self.options['apa_tweaks'],
+            self.options.get('always_include_issue', False),
+            self.options.get('publisher_website', True),
+            self.options.get('abbreviate_given_names', True))
+
+    def render1(self, d):
+        (entry, _), = render_items(self.style,
+            self.options['formatter'], [Item(self.prepared(d))],
+            self.options['apa_tweaks']).values()
+        return entry
+
+    def render_all(self):
+        ds = [self.prepared(self.items[d_id]) for d_id in
+            sorted(self.items, key = self.serials.get)]
+        with get_renderer(self.style, self.options['formatter']) as r:
+            r.reset(ds)
+            bibliography = r.bibliography
+            ids = {item.key: d['id'] for item, d in zip(bibliography.items, ds)}
+            keys = {item.key: sort_key(d, self.fold)
+                for item, d in zip(bibliography.items, ds)}
+            bibliography.items = sorted(bibliography.items,
+                key = lambda item: keys[item.key])
+            bibliography.keys = [item.key for item in bibliography.items]
+            entries = postprocess(
+                [''.join(entry) for entry in bibliography.bibliography()],
+                self.style, self.options['formatter'], self.options['apa_tweaks'])
+            return [
+                (ids[item.key], keys[item.key], entry)
+                for item, entry in zip(bibliography.items, entries)]
+
+class EntryCache(object):
+    """A size-bounded LRU cache of rendered bibliography entries
+    and inline citations, optionally backed by an SQLite
+    database (at `store_path`) so that it survives restarts.
+
+    `bib` uses the module-level instance `entry_cache`, which is
+    configured from the environment variables
+    QUICKBIB_ENTRY_CACHE_SIZE and QUICKBIB_ENTRY_STORE. Set
+    `entry_cache` to None to turn memoization off."""
+
+    def __init__(self, maxsize = 10000, store_path = None):
+        self.maxsize = maxsize
+        self.store_path = store_path
+        self.store = None
+          # The SQLite connection, opened on first use.
+        self.memory = OrderedDict()
+        self.lock = Lock()
+        self.hits = self.misses = self.evictions = self.store_hits = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+            value = self.store_get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.store_hits += 1
+                self.remember(key, value)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.remember(key, value)
+            if self.store_path is not None:
+                self.connect().execute(
+                    'insert or replace into entries values (?, ?)',
+                    (key, pickle.dumps(value)))
+
+    def flush(self):
+        with self.lock:
+            if self.store is not None:
+                self.store.commit()
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+
+    def stats(self):
+        return dict(
+            hits = self.hits, misses = self.misses,
+            evictions = self.evictions, store_hits = self.store_hits,
+            size = len(self.memory))
+
+    def remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last = False)
+            self.evictions += 1
+
+    def connect(self):
+        if self.store is None:
+            import sqlite3
+            makedirs(dirname(abspath(self.store_path)), exist_ok = True)
+            self.store = sqlite3.connect(self.store_path,
+                check_same_thread = False)
+            self.store.execute('create table if not exists entries (key text primary key, value blob)')
+        return self.store
+
+    def store_get(self, key):
+        if self.store_path is None:
+            return None
+        row = self.connect().execute(
+            'select value from entries where key = ?', (key,)).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+class Stats(object):
+    """Wall-clock time and item counts for each phase of `bib`,
+    plus counters such as style-cache hits and misses. Pass an
+    instance to `bib` as `stats`; it accumulates over calls.
+
+    If QUICKBIB_STATS is set in the environment, calls of `bib`
+    without `stats` record into the module-level instance
+    `default_stats`."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.phases = defaultdict(lambda: [0, 0., 0])
+          # Maps a phase name to [calls, seconds, items].
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def phase(self, name, items = 0):
+        t = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - t
+            with self.lock:
+                p = self.phases[name]
+                p[0] += 1
+                p[1] += elapsed
+                p[2] += items
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] += n
+
+    def merge(self, other):
+        # `other` may be a Stats or the output of `as_dict`.
+        if isinstance(other, Stats):
+            other = other.as_dict()
+        with self.lock:
+            for k, v in other['phases'].items():
+                p = self.phases[k]
+                p[0] += v['calls']
+                p[1] += v['seconds']
+                p[2] += v['items']
+            for k, n in other['counters'].items():
+                self.counters[k] += n
+
+    def as_dict(self):
+        with self.lock:
+            return dict(
+                phases = {k: dict(calls = c, seconds = s, items = n)
+                    for k, (c, s, n) in self.phases.items()},
+                counters = dict(self.counters))
+
+def codec(name):
+    """The `(encode, decode)` functions of the IPC codec `name`
+    ("json", "orjson", or "msgpack"), or None if it isn't
+    available. `encode` returns bytes and `decode` takes bytes."""
+    try:
+        if name == 'json':
+            return (
+                lambda o: json.dumps(o, ensure_ascii = False,
+                    separators = (',', ':')).encode('UTF-8'),
+                json.loads)
+        if name == 'orjson':
+            import orjson
+            return orjson.dumps, orjson.loads
+        if name == 'msgpack':
+            import msgpack
+            return (partial(msgpack.packb, use_bin_type = True),
+                partial(msgpack.unpackb, raw = False))
+    except ImportError:
+        pass
+    return None
 
 # ------------------------------------------------------------
 # Private
 # ------------------------------------------------------------
 
+citeproc_loaded = False
+citeproc_lock = Lock()
+  # citeproc's modules import each other circularly, which
+  # Python's import locks can mistake for a deadlock when two
+  # threads (e.g., `--preload` and the first request) import
+  # them at once.
+
+def load_citeproc():
+    global citeproc_loaded, citeproc_version, json_source
+    global CitationStylesStyle, CitationStylesBibliography
+    global Citation, CitationItem, CiteProcJSON
+    if citeproc_loaded:
+        return
+    with citeproc_lock:
+        if citeproc_loaded:
+            return
+        from citeproc import CitationStylesStyle, CitationStylesBibliography
+        from citeproc.source import Citation, CitationItem
+        from citeproc.source.json import CiteProcJSON
+        from citeproc.version import __version__ as citeproc_version
+        from citeproc.model import CitationStylesElement
+        json_source = CiteProcJSON([])
+        CitationStylesElement.xpath_search = memoized_xpath_search
+        citeproc_loaded = True
+
+def memoized_xpath_search(self, expression):
+    # citeproc-py looks up macros, terms, and inherited options
+    # with XPath every time it needs them, which is most of the
+    # cost of rendering a small bibliography. The trees don't
+    # change once loaded, so for any tree we've given an
+    # `xpath_memo` (see `memoize_lookups`), we remember the
+    # results. Keeping each element in the memo also keeps lxml
+    # from replacing its Python proxy, so the keys stay valid.
+    memo = getattr(self.getroottree().getroot(), 'xpath_memo', None)
+    if memo is None:
+        return self.xpath(expression, namespaces = self.nsmap)
+    k = (self, expression)
+    if k not in memo:
+        memo[k] = self.xpath(expression, namespaces = self.nsmap)
+    return memo[k]
+
+def memoize_lookups(style):
+    for e in [style.root] + style.root.locales:
+        root = e.getroottree().getroot()
+        if getattr(root, 'xpath_memo', None) is None:
+            root.xpath_memo = {}
+
+class NoStats(object):
+    # Stands in for a Stats when nobody is watching.
+    def phase(self, name, items = 0):
+        return nullcontext()
+    def count(self, name, n = 1):
+        pass
+
+no_stats = NoStats()
+
 def delf(x, i):
     try:             del x[i]
     except KeyError: pass
@@ -174,9 +843,789 @@ def delf(x, i):
 def sub1(*p, **kw):
     return sub(*p, count = 1, **kw)
 
-def title_sort_key(d):
+def get_formatter(formatter):
+    if isinstance(formatter, str):
+        try:             formatter = formatters[formatter]
+        except KeyError: raise ValueError('Unknown formatter "{}"'.format(formatter))
+        if isinstance(formatter, str):
+            load_citeproc()
+              # The formatter modules are part of citeproc-py.
+            formatter = import_module(formatter)
+    return formatter
+
+def author_year_key(d):
+    # Group works by author and year.
+    #
+    # (Actually, we use only an initial subset of authors,
+    # the same number that would be included in an inline citation
+    # after the first inline citation. This is 2 for 2 authors
+    # and 1 otherwise. For 3 or more authors, we also add a cookie
+    # for "et al.".)
+    #
+    # Each name is a tuple of its parts, so the key is hashable
+    # and orderable.
+    names = d.get('author') or d.get('editor')
+    key = [tuple(n.get(k, '') for k in name_parts) for n in names[:2]]
+    if len(names) > 2:
+        key[1] = ('etal',)
+    return (tuple(key), str(d['issued']['date-parts'][0][0]))
+
+name_parts = ('family', 'given', 'suffix',
+    'non-dropping-particle', 'dropping-particle', 'literal')
+
+def suffix_letters(i):
+    # 0 → "a", 25 → "z", 26 → "aa", 27 → "ab", and so on.
+    s = ''
+    i += 1
+    while i:
+        i, r = divmod(i - 1, 26)
+        s = ascii_lowercase[r] + s
+    return s
+
+class Item(object):
+    # A CSL item as `bib` and `render_items` handle it: the
+    # caller's dictionary `d`, left alone, plus what we've worked
+    # out about it. The prepared dictionary that citeproc-py sees
+    # is made by `csl` only when it's needed, so that a big
+    # bibliography doesn't keep a tweaked copy of every item.
+
+    __slots__ = ('d', 'id', 'key', 'options', 'sort_key', 'year_suffix')
+
+    def __init__(self, d, d_id = None, options = None):
+        # `options` are the arguments of `tweak` after `fields`,
+        # or None if `d` is already prepared, ID and all.
+        self.d = d
+        self.id = d['id'] if d_id is None else d_id
+        self.key = str(self.id).lower()
+          # The same as `citeproc_key(self.csl())`.
+        self.options = options
+        self.sort_key = self.year_suffix = None
+
+    def retarget(self, options, year_suffix = True):
+        # A copy with other `options`, and without the year
+        # suffix unless `year_suffix`.
+        it = Item(self.d, self.id, options)
+        it.sort_key = self.sort_key
+        if year_suffix:
+            it.year_suffix = self.year_suffix
+        return it
+
+    def csl(self):
+        if self.options is None:
+            return self.d
+        fields = {'id': self.id}
+        if self.year_suffix is not None:
+            fields['year_suffix'] = self.year_suffix
+        return tweak(self.d, fields, *self.options)
+
+def prepare(ds, options, fold, stats, dedup = False):
+    # Make an Item of each CSL item in `ds`, with its sort key
+    # and (if the first of `options`, `apa_tweaks`, is on) its
+    # year suffix. Also return a dictionary mapping each citeproc
+    # key to the first Item with that key; its sort key is
+    # computed once and used both for year suffixes and for
+    # ordering. Items with the same key are all replaced with the
+    # last of them, as citeproc-py would do. With `dedup`, each
+    # later item of a group of `duplicates` is replaced with the
+    # first.
+    ds = list(ds)
+    with stats.phase('ids', len(ds)):
+        items = [Item(d, item_id(d, None if dedup else i), options)
+            for i, d in enumerate(ds)]
+        lasts = {it.key: it for it in items}
+        if len(lasts) < len(items):
+            items = [Item(lasts[it.key].d, lasts[it.key].id, options)
+                for it in items]
+
+    if dedup:
+        with stats.phase('deduplication', len(items)):
+            merged = 0
+            for group in duplicate_groups([(it.id, it.d) for it in items], fold):
+                first = items[group[0]]
+                for i in group[1:]:
+                    items[i] = Item(first.d, first.id, options)
+                merged += len(group) - 1
+        stats.count('duplicates', merged)
+
+    with stats.phase('sort keys', len(items)):
+        firsts = {}
+        for it in items:
+            first = firsts.setdefault(it.key, it)
+            if first.sort_key is None:
+                first.sort_key = sort_key(first.csl(), fold)
+            it.sort_key = first.sort_key
+
+    if options[0]:
+        add_year_suffixes(items, stats)
+
+    return items, firsts
+
+def item_id(d, position = None):
+    # The caller's ID for the CSL item `d`, or else one made from
+    # its contents, so the same item gets the same ID (and hence
+    # the same entry, and a hit in `cite_cache`) every time. With
+    # `position`, its place in the input goes into the ID too, so
+    # identical items without IDs stay separate items.
+    if 'id' in d:
+        return d['id']
+    h = sha256(item_bytes(d))
+    if position is not None:
+        h.update(b'@%d' % position)
+    return h.hexdigest()[:32]
+
+def duplicate_groups(pairs, fold):
+    # `duplicates` for a list of (ID, CSL item) pairs. Items
+    # sharing any of their `identifiers` are merged, by union-find,
+    # unless that would put two DOIs in one group.
+    parent = list(range(len(pairs)))
+    dois = [d.get('DOI') and normalize_doi(d['DOI']) for _, d in pairs]
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    index = {}
+    for i, (d_id, d) in enumerate(pairs):
+        for k in chain([('id', str(d_id).lower())], identifiers(d, fold)):
+            a, b = find(index.setdefault(k, i)), find(i)
+            if a == b or (dois[a] and dois[b] and dois[a] != dois[b]):
+                continue
+            parent[b] = a
+            dois[a] = dois[a] or dois[b]
+    groups = OrderedDict()
+    for i in range(len(pairs)):
+        groups.setdefault(find(i), []).append(i)
+    return [g for g in groups.values() if len(g) > 1]
+
+def identifiers(d, fold):
+    # Keys identifying the work that the CSL item `d` describes,
+    # for `duplicate_groups`.
+    if d.get('DOI'):
+        yield 'doi', normalize_doi(d['DOI'])
+    if d.get('ISBN') and d.get('type') == 'book':
+      # A chapter has the ISBN of its book.
+        for isbn in isbn_separator.split(str(d['ISBN'])):
+            isbn = normalize_isbn(isbn)
+            if isbn:
+                yield 'isbn', isbn
+    try:
+        year = d['issued']['date-parts'][0][0]
+    except (KeyError, IndexError, TypeError):
+        year = None
+    if (d.get('title') or d.get('container-title')) and year:
+        yield 'names, year, and title', (
+            tuple(fold(n.get('family') or n.get('literal') or '')
+                for n in d.get('author') or d.get('editor') or ()),
+            str(year),
+            fold(' '.join(word.findall(title_key(d)))))
+
+def normalize_doi(doi):
+    return doi_prefix.sub('', doi.strip()).lower()
+      # DOIs are case-insensitive.
+
+doi_prefix = compile(r'(?:(?:https?://)?(?:dx\.)?doi\.org/|doi:\s*)', IGNORECASE)
+isbn_separator = compile(r'[,;/]')
+word = compile(r'\w+')
+
+def normalize_isbn(s):
+    # The ISBN-13 for an ISBN-10 or ISBN-13, or None.
+    s = sub(r'[^0-9X]', '', s.upper())
+    if len(s) == 10:
+        s = '978' + s[:9]
+        s += str(-sum(int(c) * (3 if i % 2 else 1) for i, c in enumerate(s)) % 10)
+    return s if len(s) == 13 and s.isdigit() else None
+
+target_options = ('style_path', 'formatter', 'return_cites_and_keys',
+    'apa_tweaks', 'always_include_issue', 'include_isbn', 'url_after_doi',
+    'publisher_website', 'abbreviate_given_names')
+  # What a target of `bib_multi` can set.
+
+def add_year_suffixes(items, stats):
+    # Distinguish entries that would have identical authors and years
+    # by adding suffixes to the years.
+    with stats.phase('disambiguation', len(items)):
+        index = YearSuffixes()
+        index.add((it.id, it.d, it.sort_key) for it in items)
+        suffixes = index.suffixes()
+        for it in items:
+            it.year_suffix = suffixes.get(it.id)
+
+def assemble(rendered, items, firsts, return_cites_and_keys, stats):
+    # The return value of `bib` for the Items `items`, given the
+    # output of `render_items` for them.
+    keys = list(rendered)
+    if len(items) > 1:
+        with stats.phase('sorting', len(keys)):
+            keys.sort(key = lambda k: firsts[k].sort_key)
+    bibl = [rendered[k][0] for k in keys if rendered[k][0] is not None]
+    if return_cites_and_keys:
+        fcites = [rendered[it.key][1] for it in items]
+        return (fcites, keys, bibl)
+    else:
+        return bibl
+
+def bib_together(style, formatter, items, firsts, apa_tweaks, return_cites_and_keys, stats):
+    # The return value of `bib` for the Items `items`, rendered as
+    # one bibliography, as styles whose entries aren't independent
+    # require.
+    with get_renderer(style, formatter) as r:
+        with stats.phase('registration', len(items)):
+            cites = r.reset([it.csl() for it in items])
+            bibliography = r.bibliography
+        if len(items) > 1:
+            with stats.phase('sorting', len(bibliography.items)):
+                sort_bibliography(bibliography, firsts)
+        with stats.phase('rendering', len(bibliography.items)):
+            entries = [''.join(s) for s in bibliography.bibliography()]
+        with stats.phase('postprocessing', len(entries)):
+            bibl = postprocess(entries, style, formatter, apa_tweaks)
+
+        if return_cites_and_keys:
+            with stats.phase('citations', len(cites)):
+                fcites = [bibliography.cite(c, lambda x: None) for c in cites]
+            return (fcites, bibliography.keys, bibl)
+        else:
+            return bibl
+
+def sort_bibliography(bibliography, firsts):
+    # bibliography.sort()   # Doesn't appear to handle leading "the"s correctly.
+    bibliography.items = sorted(bibliography.items,
+        key = lambda item: firsts[item.key].sort_key)
+    bibliography.keys = [item.key for item in bibliography.items]
+
+def tweak(d, fields, apa_tweaks, always_include_issue, publisher_website, abbreviate_given_names):
+    # Return the CSL item `d` with `fields` set, None values
+    # removed, and (if `apa_tweaks` is on) our APA adjustments
+    # made. `d` itself is left alone, and is only copied (shallowly)
+    # if something changes; likewise the author list is copied
+    # only if a given name changes.
+    orig = d
+    def edit():
+        nonlocal d
+        if d is orig:
+            d = dict(orig)
+        return d
+
+    for k, v in fields.items():
+        if k not in d or d[k] != v:
+            edit()[k] = v
+    for k, v in orig.items():
+        if v is None: del edit()[k]
+    if apa_tweaks:
+        # By default, don't include the issue number for
+        # journal articles.
+        if not always_include_issue and d['type'] == 'article-journal' and 'issue' in d:
+            del edit()['issue']
+        # Use the weird "Retrieved from Dewey, Cheatem, &
+        # Howe website: http://example.com" format prescribed
+        # for reports.
+        if publisher_website and d['type'] == 'report' and 'publisher' in d and 'URL' in d:
+            edit()
+            d['URL'] = '{} website: {}'.format(
+                d.pop('publisher'), d['URL'])
+        # Add structure words for presentations and include
+        # the event place.
+        if d['type'] == 'speech' and d['genre'] == 'paper':
+            edit()
+            d['event'] = 'meeting of the {}, {}'.format(
+                d.pop('publisher'), d['event-place'])
+        if d['type'] == 'speech' and d['genre'] == 'video':
+            edit()['medium'] = 'Video file'
+            del d['genre']
+        # Format encyclopedia entries like book chapters.
+        if d['type'] == 'entry-encyclopedia':
+            edit()['type'] = 'chapter'
+        # When abbreviating given names, remove hyphens
+        # preceding lowercase letters. Otherwise, weird
+        # stuff happens.
+        if abbreviate_given_names and 'author' in d:
+           authors = d['author']
+           for i, a in enumerate(authors):
+               if 'given' in a and '-' in a['given']:
+                   given = sub(
+                       '-(.)',
+                       lambda mo:
+                           ("" if mo.group(1).islower() else "-") +
+                           mo.group(1),
+                       a['given'])
+                   if given != a['given']:
+                       if authors is d['author']:
+                           authors = edit()['author'] = list(authors)
+                       authors[i] = dict(a, given = given)
+    return d
+
+def sort_key(d, fold = str.lower):
+    # The key by which the prepared CSL item `d` is sorted in the
+    # bibliography: names, then year, then title, then first
+    # page. `fold` is applied to names and titles. The pieces are
+    # taken from `d` the way citeproc-py would parse them, so we
+    # needn't wait for it.
+    names = tuple((fold(n['family']), fold(n['given'][0] if 'given' in n else ''))
+        for n in d.get('author') or d.get('editor'))
+    if 'page' in d:
+        page = d['page'].replace('–', '-')
+        page = page.split('-')[0].strip() if '-' in page else page
+        try:
+            page = int(page)
+        except ValueError:
+            pass
+    else:
+        page = ''
+    year = int(d['issued']['date-parts'][0][0])
+      # citeproc-py converts the year the same way.
+    return (names, year, title_key(d, fold), page)
+
+def title_key(d, fold = str.lower):
     s = d.get('title') or d.get('container-title')
-    return sub1(r'^a\s+|^the\s+', '', str(s).lower())
+    s = str(s)
+    if '<span' in s.lower():
+        load_citeproc()
+        s = str(json_source.parse_string(s))
+          # Drop "nocase" tags.
+    m = leading_article.match(s)
+    return fold(s[m.end():] if m else s)
+
+leading_article = compile(r'(?:a|the)\s+', IGNORECASE)
+
+def fold_accents(s):
+    # "Ångström" → "angstrom"
+    return ''.join(c for c in normalize('NFKD', s) if not combining(c)).casefold()
+
+collations = dict(simple = str.lower, accents = fold_accents)
+
+icu_sort_keys = {}
+
+def get_collation(collation):
+    # Return a function that maps names and titles to keys for
+    # sorting. `collation` may be such a function itself, None
+    # (the same as "simple", which just lowercases), "accents"
+    # (which also ignores diacritics, so "Ångström" sorts with
+    # "Angstrom"), or "icu" or "icu:LOCALE" (e.g., "icu:sv_SE")
+    # for ICU collation, which requires PyICU.
+    if collation is None:
+        return str.lower
+    if callable(collation):
+        return collation
+    name, _, locale = collation.partition(':')
+    if name != 'icu':
+        return collations[name]
+    if locale not in icu_sort_keys:
+        import icu
+        icu_sort_keys[locale] = icu.Collator.createInstance(
+            icu.Locale(locale)).getSortKey
+    return icu_sort_keys[locale]
+
+basic_rules = [
+    # Fix spacing and punctuation issues.
+    ('  ', ' '),
+    (r'([.!?…])\.', r'\1')]
+
+apa_rules = basic_rules + [
+    # Italicize the stuff between a journal name and a volume
+    # number.
+    (r'</i>, <i>(\d)', r', \1', ('html', 'chocolate')),
+    # Remove redundant periods that are separated
+    # from the first end-of-sentence mark by an </i>
+    # tag.
+    (r'([.!?…]</i>)\.', r'\1', ('html', 'chocolate')),
+    # If there are two authors and the first is a mononym,
+    # remove the comma after it.
+    (r'^([^.,\n]+), &', r'\1 &')]
+
+rule_sets = dict(basic = basic_rules, apa = apa_rules)
+style_rule_sets = {}
+  # Maps CSL style IDs to names in `rule_sets`.
+compiled_rules = {}
+  # Maps a rule-set name and formatter name to a RuleSet.
+
+class RuleSet(object):
+    # A rule set, compiled for one formatter.
+
+    def __init__(self, rules):
+        self.steps = []
+        for pattern, replacement in rules:
+            if any(c in pattern for c in '.^$*+?{}[]\\|()'):
+                self.steps.append(partial(
+                    compile(pattern, MULTILINE).sub, replacement))
+            else:
+                self.steps.append(
+                    lambda s, p = pattern, r = replacement: s.replace(p, r))
+        self.digest = sha256(json.dumps(rules).encode('UTF-8')).hexdigest()
+
+    def apply1(self, s):
+        for step in self.steps:
+            s = step(s)
+        return s
+
+    def apply(self, entries):
+        # Rather than running every rule over every entry, we run
+        # every rule once over all the entries joined by newlines.
+        if len(entries) < 2 or any('\n' in e for e in entries):
+            return [self.apply1(e) for e in entries]
+        out = self.apply1('\n'.join(entries)).split('\n')
+        if len(out) != len(entries):
+        # A rule added or removed a newline.
+            return [self.apply1(e) for e in entries]
+        return out
+
+def rules_for(style, formatter, apa_tweaks):
+    name = (style_rule_sets.get(style.root.info.id.text, 'apa')
+        if apa_tweaks else 'basic')
+    k = (name, formatter_name(formatter))
+    if k not in compiled_rules:
+        compiled_rules[k] = RuleSet([r[:2]
+            for r in rule_sets[name]
+            if len(r) < 3 or k[1] in r[2]])
+    return compiled_rules[k]
+
+def postprocess(entries, style, formatter, apa_tweaks):
+    # Fix spacing and punctuation issues in a list of rendered
+    # entries.
+    return rules_for(style, formatter, apa_tweaks).apply(entries)
+
+def entries_independent(style):
+    # Whether each bibliography entry can be rendered without
+    # regard to the others. Citation numbers, position tests,
+    # and subsequent-author substitution all make an entry
+    # depend on the rest of the bibliography.
+    return (
+        style.root.bibliography is None or
+        style.root.bibliography.get('subsequent-author-substitute') is None) and not any(
+            e.get('variable') == 'citation-number' or e.get('position')
+            for e in style.root.iter())
+
+def citeproc_key(d):
+    # citeproc-py identifies items by their lowercased IDs.
+    return str(d['id']).lower()
+
+def formatter_name(formatter):
+    for k, v in formatters.items():
+        if v is formatter or v == getattr(formatter, '__name__', None):
+            return k
+    return repr(formatter)
+
+entry_cache_version = 3
+  # Increment this whenever `tweak` or `postprocess` changes,
+  # or the format of the entries or their keys, so stored
+  # entries are ignored.
+
+def entry_cache_key(style, formatter, apa_tweaks, rules_digest, d):
+    return entry_cache_hasher(style, formatter, apa_tweaks, rules_digest)(
+        item_bytes(d))
+
+def entry_cache_hasher(style, formatter, apa_tweaks, rules_digest):
+    # Return a function from the `item_bytes` of a prepared CSL
+    # item to its key in `entry_cache`. The part of the hash that
+    # doesn't depend on the item is computed once.
+    prefix = sha256(json.dumps(
+        [entry_cache_version, citeproc_version, style.digest,
+            formatter_name(formatter), apa_tweaks, rules_digest]).encode('UTF-8'))
+    def key(b):
+        h = prefix.copy()
+        h.update(b)
+        return h.hexdigest()
+    return key
+
+def item_bytes(d):
+    # The ID doesn't affect rendering, so leave it out.
+    return json.dumps({k: v for k, v in d.items() if k != 'id'},
+        sort_keys = True, ensure_ascii = False, default = str).encode('UTF-8')
+
+def render_items(style, formatter, items, apa_tweaks, workers = None, stats = no_stats):
+    # Render each of the Items `items` on its own, going
+    # through `entry_cache`. Returns a dictionary, in input order,
+    # mapping the citeproc key of each distinct item to a pair
+    # of the entry (or None if the style produced nothing) and
+    # the inline citation. Only use this when
+    # `style.independent` is true.
+    #
+    # If `workers` is more than 1, cache misses are split among
+    # that many processes. Their time is recorded in `stats` under
+    # "rendering". Otherwise, they're rendered `render_chunk_size`
+    # at a time, so citeproc-py's copies of the items don't all
+    # exist at once.
+    return render_many([(style, formatter, items, apa_tweaks)], workers, stats)[0]
+
+def render_many(jobs, workers = None, stats = no_stats):
+    # `render_items` for each of `jobs`, which are tuples of its
+    # first four arguments. With `workers`, the misses of every
+    # job are submitted to the pool at once, so the jobs are
+    # rendered concurrently.
+    load_citeproc()
+      # For `citeproc_version`.
+    results = []
+    misses = []
+    encoded = {} if len(jobs) > 1 else None
+      # Maps the `d`, options, and year suffix of an Item to the
+      # `item_bytes` of its `csl`, for jobs that differ only in
+      # style or formatter.
+    def csl_bytes(it):
+        if encoded is None:
+            return item_bytes(it.csl())
+        k = (id(it.d), it.options, it.year_suffix)
+        if k not in encoded:
+            encoded[k] = item_bytes(it.csl())
+        return encoded[k]
+    with stats.phase('cache lookup', sum(len(items) for _, _, items, _ in jobs)):
+        for i, (style, formatter, items, apa_tweaks) in enumerate(jobs):
+            rendered = {}
+            key = entry_cache_hasher(style, formatter, apa_tweaks,
+                rules_for(style, formatter, apa_tweaks).digest)
+            for it in items:
+                if it.key in rendered:
+                    continue
+                ck = key(csl_bytes(it))
+                v = entry_cache and entry_cache.get(ck)
+                if v is None:
+                    misses.append((i, it.key, ck, it))
+                rendered[it.key] = v
+            results.append(rendered)
+    stats.count('entry cache hits', sum(map(len, results)) - len(misses))
+    stats.count('entry cache misses', len(misses))
+
+    if not misses:
+        return results
+    remote = workers and workers > 1 and len(misses) > 1
+    tasks = [(i, c)
+        for i, group in groupby(misses, key = itemgetter(0))
+        for c in chunks(group,
+            -(-len(misses) // (4 * workers)) if remote else render_chunk_size)]
+    pool = remote and get_worker_pool(workers)
+    futures = [
+        pool.submit(render_remotely, jobs[i][0].idx, formatter_name(jobs[i][1]),
+            [it.csl() for _, _, _, it in c], jobs[i][3])
+        if remote and formatter_name(jobs[i][1]) in formatters
+        else None
+        for i, c in tasks]
+      # Everything goes to the pool before we render anything
+      # here, so the workers are busy meanwhile.
+    def store(i, c, values):
+        for (_, k, ck, _), v in zip(c, values):
+            results[i][k] = v
+            if entry_cache:
+                entry_cache.put(ck, v)
+    for (i, c), future in zip(tasks, futures):
+        if future is None:
+            style, formatter, _, apa_tweaks = jobs[i]
+            store(i, c, render_uncached(style, formatter,
+                [it.csl() for _, _, _, it in c], apa_tweaks, stats))
+    waiting = [(i, c, future)
+        for (i, c), future in zip(tasks, futures)
+        if future is not None]
+    if waiting:
+        with stats.phase('rendering', sum(len(c) for _, c, _ in waiting)):
+            for i, c, future in waiting:
+                store(i, c, future.result())
+    if entry_cache:
+        entry_cache.flush()
+    return results
+
+def cite_items(style, formatter, items, apa_tweaks, stats = no_stats):
+    # Like `render_items`, but produce only the inline citation of
+    # each distinct item. Citations are memoized in `cite_cache`
+    # under the caller's dictionary (pickled) and year suffix, so
+    # a hit needn't `tweak` the item. Misses are looked up in
+    # `entry_cache`, in case `bib` has rendered the item already,
+    # before being rendered.
+    load_citeproc()
+    cited = {}
+    misses = []
+    with stats.phase('cache lookup', len(items)):
+        for it in items:
+            if it.key in cited:
+                continue
+            ck = (style.digest, formatter_name(formatter), it.options, it.year_suffix,
+                pickle.dumps({k: v for k, v in it.d.items() if k != 'id'}))
+              # Quicker than JSON. Equal items can pickle differently
+              # (say, with their keys in another order), but that
+              # only costs us a miss.
+            v = cite_cache and cite_cache.get(ck)
+            if v is None:
+                misses.append((it.key, ck, it))
+            cited[it.key] = v
+    stats.count('cite cache hits', len(cited) - len(misses))
+    stats.count('cite cache misses', len(misses))
+    if not misses:
+        return cited
+
+    rules_digest = entry_cache and rules_for(style, formatter, apa_tweaks).digest
+    fresh = []
+    for key, ck, it in misses:
+        v = entry_cache and entry_cache.get(entry_cache_key(
+            style, formatter, apa_tweaks, rules_digest, it.csl()))
+        if v is None:
+            fresh.append((key, ck, it))
+        else:
+            cited[key] = v[1]
+    if fresh:
+        compiled = render_compiled(style, formatter, [it.csl() for _, _, it in fresh], stats)
+        for (key, _, _), x in zip(fresh, compiled):
+            if x is not None:
+                cited[key] = x[1]
+        fresh = [f for f, x in zip(fresh, compiled) if x is None]
+    for c in chunks(fresh, render_chunk_size):
+        with get_renderer(style, formatter) as r:
+            with stats.phase('registration', len(c)):
+                citations = r.reset([it.csl() for _, _, it in c])
+            with stats.phase('citations', len(c)):
+                for (key, _, _), citation in zip(c, citations):
+                    cited[key] = r.bibliography.cite(citation, lambda x: None)
+    if cite_cache:
+        for key, ck, _ in misses:
+            cite_cache.put(ck, cited[key])
+    return cited
+
+def render_uncached(style, formatter, ds, apa_tweaks, stats = no_stats):
+    rendered = render_compiled(style, formatter, ds, stats)
+    rest = [d for d, x in zip(ds, rendered) if x is None]
+    if rest:
+        with get_renderer(style, formatter) as r:
+            with stats.phase('registration', len(rest)):
+                citations = r.reset(rest)
+            with stats.phase('rendering', len(rest)):
+                slow = iter([
+                    (style.render_bibliography([item]), r.bibliography.cite(c, lambda x: None))
+                    for item, c in zip(r.bibliography.items, citations)])
+        rendered = [x or next(slow) for x in rendered]
+    with stats.phase('postprocessing', len(ds)):
+        entries = iter(postprocess(
+            [''.join(entry[0]) for entry, _ in rendered if entry],
+            style, formatter, apa_tweaks))
+        return [
+            (next(entries) if entry else None, cite)
+            for entry, cite in rendered]
+
+def render_compiled(style, formatter, ds, stats = no_stats):
+    # For each of the prepared items `ds`, the pair of results
+    # that `render_uncached` gets from citeproc-py, if the item's
+    # type is in `compiled_types` and `quickbib_compile` can render
+    # it, or else None.
+    if not compiled_types:
+        return [None] * len(ds)
+    compiled = import_module('quickbib_compile').compiled
+    with stats.phase('compiled rendering', len(ds)):
+        rendered = []
+        for d in ds:
+            c = d.get('type') in compiled_types and compiled(style, formatter, d['type'])
+            rendered.append(c.render(d) if c else None)
+    n = sum(x is not None for x in rendered)
+    stats.count('compiled entries', n)
+    stats.count('compiled fallbacks', sum(d.get('type') in compiled_types for d in ds) - n)
+    return rendered
+
+class Renderer(object):
+    # A citeproc-py bibliography for one style and formatter,
+    # which can be reset with new items instead of being built
+    # from scratch for every call. Get one with `get_renderer`.
+
+    def __init__(self, style, formatter):
+        load_citeproc()
+        self.style = style
+        self.formatter = formatter
+        self.source = CiteProcJSON([])
+        self.bibliography = CitationStylesBibliography(
+            style, self.source, formatter)
+
+    def reset(self, ds):
+        # Replace the items with the prepared items `ds`, and
+        # return a Citation for each.
+        self.clear()
+        CiteProcJSON.__init__(self.source, ds)
+        self.bibliography.formatter = self.style.root.formatter = self.formatter
+          # The style's Renderers for other formatters may have
+          # set it since. `get_renderer` makes sure they're idle.
+        citations = [Citation([CitationItem(d['id'])]) for d in ds]
+        keys, items = self.bibliography.keys, self.bibliography.items
+        seen = set()
+        for c in citations:
+        # Equivalent to `bibliography.register(c)`, which takes
+        # quadratic time since it checks for duplicates with a list.
+            c.bibliography = self.bibliography
+            for item in c.cites:
+                if item.key in self.source and item.key not in seen:
+                    seen.add(item.key)
+                    keys.append(item.key)
+                    items.append(item)
+        return citations
+
+    def clear(self):
+        self.source.clear()
+        self.bibliography.keys = []
+        self.bibliography.items = []
+        self.bibliography._cites = []
+
+@contextmanager
+def get_renderer(style, formatter):
+    # Use the style's one Renderer for `formatter`, making it the
+    # first time. citeproc-py keeps the formatter, and the state of
+    # a render in progress, on the parsed style itself, so only one
+    # thread at a time may use any of a style's Renderers; other
+    # callers wait their turn.
+    with style.lock:
+        r = style.renderers.get(formatter)
+        if r is None:
+            r = style.renderers[formatter] = Renderer(style, formatter)
+        try:
+            yield r
+        finally:
+            r.clear()
+              # Don't keep the items alive while idle.
+
+def render_remotely(style_idx, formatter_name, ds, apa_tweaks):
+    # Run in a worker process. The worker's own style cache
+    # keeps the style loaded between calls.
+    return render_uncached(get_style(*style_idx),
+        get_formatter(formatter_name), ds, apa_tweaks)
+
+render_chunk_size = 1000
+
+worker_pools = {}
+
+def get_worker_pool(workers):
+    if workers not in worker_pools:
+        from concurrent.futures import ProcessPoolExecutor
+        worker_pools[workers] = ProcessPoolExecutor(workers)
+    return worker_pools[workers]
+
+def read_json_lines(path):
+    with open(path, encoding = 'UTF-8') as f:
+        for l in f:
+            if l.strip():
+                yield json.loads(l)
+
+def chunks(iterable, n):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+def external_sort(records, chunk_size):
+    # Sort an iterable of (key, value) pairs by key, holding at
+    # most `chunk_size` of them in memory. Sorted runs are
+    # pickled to temporary files and then merged.
+    from tempfile import TemporaryFile
+    runs = []
+    try:
+        for chunk in chunks(records, chunk_size):
+            chunk.sort(key = itemgetter(0))
+            f = TemporaryFile()
+            for r in chunk:
+                pickle.dump(r, f, pickle.HIGHEST_PROTOCOL)
+            f.seek(0)
+            runs.append(f)
+        yield from merge(*map(read_run, runs), key = itemgetter(0))
+    finally:
+        for f in runs:
+            f.close()
+
+def read_run(f):
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
 
 class chocolate(object):
     "A formatter that isn't quite plain."
@@ -199,21 +1648,62 @@ class chocolate(object):
             items = map(str, items)
             return super().__new__(cls, '\n\n'.join(items))
 
-formatter_from_name = dict(
-    plain = citeproc.formatter.plain,
-    html = citeproc.formatter.html,
+formatters = dict(
+    plain = 'citeproc.formatter.plain',
+    html = 'citeproc.formatter.html',
     chocolate = chocolate)
+  # Strings are the names of modules to import on first use.
 
 style_cache = {}
+  # Maps a style path and tweak tuple to a pair of the style
+  # file's modification time and the parsed style.
+
+entry_cache = EntryCache(
+    int(environ.get('QUICKBIB_ENTRY_CACHE_SIZE', 10000)),
+    environ.get('QUICKBIB_ENTRY_STORE') or None)
+
+cite_cache = EntryCache(
+    int(environ.get('QUICKBIB_ENTRY_CACHE_SIZE', 10000)))
+  # For `cites`. In memory only, since citations are quick to
+  # make again.
+
+default_stats = Stats() if environ.get('QUICKBIB_STATS') else None
 
-def get_style(style_path, apa_tweaks, include_isbn, url_after_doi, abbreviate_given_names):
+compiled_types = (('article-journal', 'chapter', 'book')
+    if environ.get('QUICKBIB_COMPILE') else ())
+  # Item types to render with `quickbib_compile`, where it can,
+  # instead of citeproc-py.
 
-    idx = (style_path, apa_tweaks, include_isbn, url_after_doi, abbreviate_given_names)
-    if idx in style_cache:
-        return style_cache[idx]
+def get_style(style_path, apa_tweaks, include_isbn, url_after_doi, abbreviate_given_names, stats = no_stats):
+
+    tweaks = (apa_tweaks, include_isbn, url_after_doi, abbreviate_given_names)
+    idx = (style_path,) + tweaks
+    mtime = stat(style_path).st_mtime_ns
+    if idx in style_cache and style_cache[idx][0] == mtime:
+        stats.count('style cache hits')
+        return style_cache[idx][1]
+    stats.count('style cache misses')
 
     with open(style_path, encoding = 'UTF-8') as f:
-         text = f.read()
+        text = patch_style(f.read(), *tweaks)
+
+    load_citeproc()
+    style = CitationStylesStyle(StringIO(text), validate = False)
+      # Validation is turned off since standard stylesheets,
+      # including apa.csl, appear not to be valid.
+    style.idx = idx
+    style.digest = sha256(text.encode('UTF-8')).hexdigest()
+    style.independent = entries_independent(style)
+    style.renderers = {}
+    style.compiled = {}
+    style.lock = Lock()
+      # These six attributes are our own additions.
+    memoize_lookups(style)
+    style_cache[idx] = (mtime, style)
+    return style
+
+def patch_style(text, apa_tweaks, include_isbn, url_after_doi, abbreviate_given_names):
+
     text = sub1(' encoding="[^"]+"', '', text)
       # lxml doesn't like encoding declarations.
 
@@ -254,26 +1744,230 @@ def get_style(style_path, apa_tweaks, include_isbn, url_after_doi, abbreviate_gi
                 r'<group delimiter=". ">\1<text variable="URL" prefix="Retrieved from "/></group>',
                 text)
 
-    style = CitationStylesStyle(StringIO(text), validate = False)
-      # Validation is turned off since standard stylesheets,
-      # including apa.csl, appear not to be valid.
-    style_cache[idx] = style
-    return style
+    return text
 
 # ------------------------------------------------------------
 # Mainline code
 # ------------------------------------------------------------
 
-if __name__ == '__main__':
-    # Accept IPC commands.
-    for l in stdin:
-        o = json.loads(l)
-        if o['command'] == 'quit':
-            exit()
-        elif o['command'] == 'bib1':
-            print(json.dumps({'value': bib1(**o['args'])}))
+def handle(o, stats = None):
+    # Carry out one IPC command, other than "quit", and return
+    # the reply. The reply echoes the request's "id", if any.
+    # Unless `stats` is given, timings go into a fresh Stats,
+    # which is returned as the reply's "stats"; `finish` then
+    # takes it out again unless the client asked for it.
+    top = stats is None
+    if top:
+        stats = Stats()
+    try:
+        if o['command'] == 'bib1':
+            r = {'value': bib1(stats = stats, **o['args'])}
         elif o['command'] == 'bib':
-            print(json.dumps({'value': bib(**o['args'])}))
+            r = {'value': bib(stats = stats, **o['args'])}
+        elif o['command'] == 'bib_multi':
+            r = {'value': bib_multi(stats = stats, **o['args'])}
+        elif o['command'] == 'cites':
+            r = {'value': cites(stats = stats, **o['args'])}
+        elif o['command'] == 'duplicates':
+            r = {'value': duplicates(**o['args'])}
+        elif o['command'] == 'batch':
+            r = {'value': batch(stats = stats, **o['args'])}
+        elif o['command'] == 'stats':
+            r = {'value': server_stats.as_dict()}
+        else:
+            r = {'error': 'Illegal command: ' + o['command']}
+    except Exception as e:
+        r = {'error': '{}: {}'.format(type(e).__name__, e)}
+    if top and o['command'] != 'stats':
+        r['stats'] = stats.as_dict()
+    if 'id' in o:
+        r['id'] = o['id']
+    return r
+
+server_stats = Stats()
+  # Accumulates the timings of every request this process has
+  # replied to, for the "stats" command.
+
+def finish(o, r):
+    # Add the timings in the reply `r` to request `o` to
+    # `server_stats`, and drop them from the reply unless `o`
+    # has a true "stats".
+    if 'stats' in r:
+        server_stats.merge(r['stats'])
+        if not o.get('stats'):
+            del r['stats']
+    return r
+
+class Framing(object):
+    # How IPC messages are delimited on a binary stream: as lines
+    # of JSON, or as a 4-byte big-endian length followed by that
+    # many bytes of a `codec`.
+
+    def __init__(self, codec_name = None):
+        self.codec_name = codec_name
+        if codec_name is None:
+            self.encode = lambda o: json.dumps(o).encode('UTF-8')
+            self.decode = json.loads
+        else:
+            self.encode, self.decode = codec(codec_name)
+
+    def read(self, rfile):
+        # Return None at the end of the stream.
+        if self.codec_name is None:
+            l = rfile.readline()
+            return self.decode(l) if l else None
+        header = rfile.read(4)
+        if len(header) < 4:
+            return None
+        return self.decode(rfile.read(int.from_bytes(header, 'big')))
+          # The message goes straight from the buffer to the
+          # decoder; there's no line to scan for.
+
+    def write(self, wfile, o):
+        b = self.encode(o)
+        if self.codec_name is None:
+            wfile.write(b)
+            wfile.write(b'\n')
         else:
-            print(json.dumps({'error': 'Illegal command: ' + o['command']}))
-        stdout.flush()
+            wfile.write(len(b).to_bytes(4, 'big'))
+            wfile.write(b)
+
+def negotiate(o):
+    # Handle a "framing" command, whose "codecs" are in order of
+    # preference. Return the reply and the new Framing (or None,
+    # to keep the old one).
+    for name in o['args']['codecs']:
+        if codec(name) is not None:
+            return {'value': name}, Framing(name)
+    return {'error': 'No supported codec among: ' +
+        ', '.join(o['args']['codecs'])}, None
+
+def serve(rfile, wfile, executor = None):
+    # Read commands from the binary stream `rfile` and carry them
+    # out on `executor` (or, if there's none, one at a time),
+    # writing each reply to `wfile` as soon as it's ready. Clients
+    # that send more than one request at a time should give each
+    # an "id" to match up the replies.
+    if executor is not None:
+        from concurrent.futures import Future, wait
+          # Not needed otherwise, and slow to import.
+    write_lock = Lock()
+    framing = Framing()
+    def write(o, r):
+        finish(o, r)
+        with write_lock:
+            framing.write(wfile, r)
+            wfile.flush()
+    def reply(o, future, replied):
+        try:
+            r = future.result()
+        except Exception as e:
+            r = {'error': '{}: {}'.format(type(e).__name__, e)}
+            if 'id' in o:
+                r['id'] = o['id']
+        write(o, r)
+        replied.set_result(None)
+    pending = set()
+    while True:
+        o = framing.read(rfile)
+        if o is None or o['command'] == 'quit':
+            break
+        if o['command'] == 'framing':
+            if pending:
+                wait(pending)
+                  # So earlier replies are written in the old framing.
+            r, new = negotiate(o)
+            if 'id' in o:
+                r['id'] = o['id']
+            framing.write(wfile, r)
+            wfile.flush()
+            framing = new or framing
+            continue
+        if o['command'] == 'stats' or executor is None:
+        # Answer "stats" from this process, which sees every
+        # reply, rather than from a worker.
+            write(o, handle(o))
+            continue
+        future = executor.submit(handle, o)
+        replied = Future()
+        pending.add(replied)
+        future.add_done_callback(
+            lambda future, o = o, replied = replied: reply(o, future, replied))
+    if pending:
+        wait(pending)
+
+def warm(style_paths):
+    # Load the given styles, with the default options, into the
+    # style cache.
+    for p in style_paths:
+        get_style(p, True, False, False, True)
+
+if __name__ == '__main__':
+    if len(argv) == 1:
+        # Accept IPC commands. This is the usual case, so we skip
+        # setting up argparse, which takes a few milliseconds.
+        serve(stdin.buffer, stdout.buffer)
+        exit()
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(prog = 'python3 -m quickbib',
+        description = 'Accept IPC commands as lines of JSON.')
+    parser.add_argument('--workers', type = int, default = 0,
+        help = 'handle this many requests concurrently (default: one at a time, in order)')
+    parser.add_argument('--threads', action = 'store_true',
+        help = 'use threads instead of processes for the workers')
+    parser.add_argument('--socket', metavar = 'PATH',
+        help = 'listen on this Unix-domain socket instead of standard input')
+    parser.add_argument('--style', metavar = 'PATH', action = 'append', default = [],
+        help = 'load this style ahead of time (may be repeated)')
+    parser.add_argument('--preload', action = 'store_true',
+        help = 'import citeproc-py and load styles in the background while waiting for the first command')
+    args = parser.parse_args(argv[1:])
+
+    if args.preload and (args.threads or not (args.workers or args.socket)):
+        # Forked workers could inherit import locks held by the
+        # preloading thread, so we preload in the background only
+        # when there won't be any.
+        Thread(target = preload, args = (args.style,), daemon = True).start()
+    else:
+        warm(args.style)
+
+    if not args.workers and not args.socket:
+        # Accept IPC commands.
+        serve(stdin.buffer, stdout.buffer)
+        exit()
+
+    if args.threads:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(args.workers or 1)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(args.workers or 1,
+            initializer = warm, initargs = (args.style,))
+
+    if not args.socket:
+        serve(stdin.buffer, stdout.buffer, executor)
+        executor.shutdown()
+        exit()
+
+    from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+    from signal import signal, SIGTERM
+    class Handler(StreamRequestHandler):
+        def handle(self):
+            serve(self.rfile, self.wfile, executor)
+    try:
+        unlink(args.socket)
+    except FileNotFoundError:
+        pass
+    signal(SIGTERM, lambda signum, frame: exit())
+      # So that we clean up the socket.
+    with ThreadingUnixStreamServer(args.socket, Handler) as server:
+        server.daemon_threads = True
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            unlink(args.socket)
+            executor.shutdown()
@@ -0,0 +1,253 @@
+# An asyncio client for the quickbib IPC server (`python3 -m
+# quickbib`). Say
+#
+#     async with Client() as client:
+#         entry = await client.bib1(style_path, d)
+#
+# Requests are spread over a pool of server processes, each of
+# which handles several at once, and replies are matched up with
+# requests by ID, so any number of coroutines can share a client.
+# Messages are length-prefixed in the quickest codec both ends
+# have, rather than lines of JSON.
+
+from sys import executable
+from os import killpg
+from os.path import dirname, abspath
+from signal import SIGKILL
+from itertools import count
+import asyncio, json
+from quickbib import codec
+
+# ----------------------------------------------------------
+# * Public
+# ----------------------------------------------------------
+
+class Error(Exception):
+    """The server replied with an error, or died before replying."""
+
+class Client(object):
+    """A pool of `processes` quickbib servers, each started with
+    `server_args` (by default, `--workers 2 --preload`). At most
+    `max_pending` requests are outstanding at once; further calls
+    wait their turn. A request that takes longer than `timeout`
+    seconds raises `asyncio.TimeoutError`. A server that exits is
+    started again on its next request. `codecs` are the IPC codecs
+    (see `quickbib.codec`) to try, in order of preference; if
+    none are available, we stick to lines of JSON."""
+
+    def __init__(self, processes = 1, server_args = ('--workers', '2', '--preload'),
+            timeout = None, max_pending = 64, python3 = executable,
+            codecs = ('orjson', 'msgpack', 'json')):
+        codecs = [c for c in codecs if codec(c) is not None]
+        self.servers = [Server([python3, '-m', 'quickbib'] + list(server_args), codecs)
+            for _ in range(processes)]
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(max_pending)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def start(self):
+        await asyncio.gather(*(s.start() for s in self.servers))
+
+    async def close(self):
+        await asyncio.gather(*(s.close() for s in self.servers))
+
+    async def command(self, command, timeout = None, stats = False, **args):
+        """Send an IPC command and return its reply's "value"
+        (or, with `stats`, the whole reply)."""
+        o = dict(command = command, args = args)
+        if stats:
+            o['stats'] = True
+        r = await self.submit(o, timeout)
+        return r if stats else r['value']
+
+    async def submit(self, o, timeout, server = None):
+        # Send the request `o` to `server`, or the least busy one,
+        # once there's a slot free, and return the reply.
+        async with self.slots:
+            server = server or min(self.servers, key = lambda s: s.busy)
+            server.busy += 1
+            try:
+                r = await asyncio.wait_for(self.retrying(server, o),
+                    timeout if timeout is not None else self.timeout)
+            finally:
+                server.busy -= 1
+        if 'error' in r:
+            raise Error(r['error'])
+        return r
+
+    async def retrying(self, server, o):
+        # Commands have no side effects, so if the server dies
+        # before replying, we can safely try once more with a new
+        # one.
+        try:
+            return await server.request(o)
+        except Error:
+            return await server.request(o)
+
+    async def bib(self, style_path, ds, **kws):
+        return await self.command('bib', style_path = style_path, ds = list(ds), **kws)
+
+    async def bib1(self, style_path, d, **kws):
+        return await self.command('bib1', style_path = style_path, d = d, **kws)
+
+    async def bib_multi(self, ds, targets, **kws):
+        return await self.command('bib_multi', ds = list(ds), targets = targets, **kws)
+
+    async def cites(self, style_path, ds, **kws):
+        return await self.command('cites', style_path = style_path, ds = list(ds), **kws)
+
+    async def duplicates(self, ds, **kws):
+        return await self.command('duplicates', ds = list(ds), **kws)
+
+    async def stats(self, timeout = None):
+        """Each server's timings and counters, as returned by the
+        "stats" command."""
+        return [r['value'] for r in await asyncio.gather(*(
+            self.submit(dict(command = 'stats'), timeout, s)
+            for s in self.servers))]
+
+# ----------------------------------------------------------
+# * Private
+# ----------------------------------------------------------
+
+class Server(object):
+    # One server process, started on demand.
+
+    def __init__(self, argv, codecs):
+        self.argv = argv
+        self.codecs = codecs
+        self.codec_name = None
+          # None for lines of JSON.
+        self.process = None
+        self.watcher = None
+        self.pending = {}
+          # Maps request IDs to futures.
+        self.ids = count()
+        self.busy = 0
+          # The number of requests waiting on this server.
+        self.lock = asyncio.Lock()
+
+    async def start(self):
+        async with self.lock:
+            if self.process is not None:
+                return
+            process = await asyncio.create_subprocess_exec(*self.argv,
+                cwd = dirname(abspath(__file__)),
+                  # So `-m quickbib` finds the quickbib next to us.
+                stdin = asyncio.subprocess.PIPE,
+                stdout = asyncio.subprocess.PIPE,
+                limit = 1 << 28,
+                  # The longest line (that is, reply) we'll read.
+                start_new_session = True)
+                  # So we can clean up after the server's workers
+                  # if it dies without them.
+            self.codec_name = None
+            self.encode, self.decode = (
+                lambda o: json.dumps(o).encode('UTF-8') + b'\n', json.loads)
+            if self.codecs:
+                self.send(process, dict(command = 'framing',
+                    args = dict(codecs = self.codecs)))
+                l = await process.stdout.readline()
+                self.codec_name = json.loads(l).get('value') if l else None
+                  # If the server has already died, `watch` will
+                  # notice.
+                if self.codec_name:
+                    self.encode, self.decode = codec(self.codec_name)
+            self.process = process
+            self.watcher = asyncio.ensure_future(self.watch(process))
+
+    async def request(self, o):
+        await self.start()
+        process = self.process
+        o = dict(o, id = next(self.ids))
+        future = self.pending[o['id']] = asyncio.get_running_loop().create_future()
+        try:
+            self.send(process, o)
+            await process.stdin.drain()
+              # If the server is slow to read, wait.
+            return await future
+        except (BrokenPipeError, ConnectionResetError):
+            self.died(process)
+            raise Error('The server exited')
+        finally:
+            self.pending.pop(o['id'], None)
+              # Also forgets requests that timed out or were
+              # cancelled. Their replies are ignored.
+
+    def send(self, process, o):
+        b = self.encode(o)
+        if self.codec_name:
+            process.stdin.write(len(b).to_bytes(4, 'big'))
+        process.stdin.write(b)
+
+    async def watch(self, process):
+        reading = asyncio.ensure_future(self.read(process))
+        while process.returncode is None:
+            await asyncio.sleep(.1)
+          # Not `process.wait()`, which also waits for the pipes
+          # to close. If the server was killed, its orphaned
+          # workers hold them open until we kill them below, and
+          # asyncio has no public way to wait for just the exit.
+          # Polling costs each server a wakeup every 0.1 s, and we
+          # may notice a death up to 0.1 s late.
+        kill(process)
+        await reading
+        self.died(process)
+
+    async def read(self, process):
+        while True:
+            try:
+                if self.codec_name:
+                    n = int.from_bytes(await process.stdout.readexactly(4), 'big')
+                    r = self.decode(await process.stdout.readexactly(n))
+                else:
+                    l = await process.stdout.readline()
+                    if not l:
+                        return
+                    r = self.decode(l)
+                future = self.pending.get(r.get('id'))
+            except asyncio.IncompleteReadError:
+                return
+            except Exception:
+              # We can't tell which request a garbled reply was
+              # for, so give up on the server. `watch` will fail
+              # what's pending on it.
+                kill(process)
+                return
+            if future is not None and not future.done():
+                future.set_result(r)
+
+    def died(self, process):
+        # Fail everything that was waiting on `process`, and
+        # arrange for the next request to start a new one.
+        if process is not self.process:
+            return
+        self.process = None
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(Error('The server exited'))
+        self.pending.clear()
+
+    async def close(self):
+        async with self.lock:
+            process = self.process
+            if process is None:
+                return
+            self.send(process, dict(command = 'quit'))
+            process.stdin.close()
+            await self.watcher
+              # `watch` calls `died`, which fails whatever is still
+              # pending and forgets the process.
+
+def kill(process):
+    # Kill the server `process` and any workers it left behind.
+    try:
+        killpg(process.pid, SIGKILL)
+    except ProcessLookupError:
+        pass
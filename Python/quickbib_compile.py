@@ -0,0 +1,867 @@
+# Compiles a CSL style, as citeproc-py has loaded it, into Python
+# closures for one item type at a time, so items of the commonest
+# types can be rendered without citeproc-py walking the style's
+# XML for each of them. A compiled layout does what citeproc-py
+# would do (the same operations on the same string objects, in the
+# same order), but everything that depends only on the style and
+# the item type is settled once: which branches of each `choose`
+# can apply, names options, terms, formatting, and affixes. What
+# we don't handle, whether in the style or in a particular item,
+# is left to citeproc-py.
+
+from functools import reduce
+from operator import add
+from threading import Lock
+from unicodedata import lookup
+from citeproc import NAMES, DATES
+from citeproc.model import TextCased, Text, Number, Label
+from citeproc.source import VariableError, Date, DateRange, LiteralDate
+from citeproc.source.json import CiteProcJSON
+from citeproc.string import String
+
+# ----------------------------------------------------------
+# * Public
+# ----------------------------------------------------------
+
+def compiled(style, formatter, item_type):
+    """The `Compiled` for items of `item_type` in `style` (as
+    returned by `quickbib.get_style`) with `formatter`, or None if
+    the style is beyond us. Either way, it's kept with the style."""
+    k = (formatter, item_type)
+    try:
+        return style.compiled[k]
+    except KeyError:
+        pass
+    with compile_lock:
+        if k not in style.compiled:
+            try:
+                style.compiled[k] = Compiled(style, formatter, item_type)
+            except Unsupported:
+                style.compiled[k] = None
+        return style.compiled[k]
+
+class Compiled(object):
+    """The bibliography entry and citation of items of one type, as
+    citeproc-py renders them with the given style and formatter."""
+
+    def __init__(self, style, formatter, item_type):
+        root = style.root
+        if root.bibliography is None or root.citation is None:
+            raise Unsupported
+        self.language = root.get('default-locale', 'en')[:2]
+        self.entry = Compiler(root.bibliography, formatter, item_type).layout()
+        self.cite = Compiler(root.citation, formatter, item_type).layout()
+
+    def render(self, d):
+        """Return the pair (the result of `render_bibliography` for
+        the item, the result of citing it alone) for the CSL item
+        `d`, or None if citeproc-py must render it."""
+        try:
+            ref = reference(d)
+            try:
+                language = ref['language'][:2]
+            except VariableError:
+                language = self.language
+            return [self.entry(ref, State(language))], self.cite(ref, State(language))
+        except Exception:
+            return None
+
+# ----------------------------------------------------------
+# * Private
+# ----------------------------------------------------------
+
+compile_lock = Lock()
+
+class Unsupported(Exception):
+    # Raised at compile time for a part of a style we don't
+    # handle.
+    pass
+
+class Fallback(Exception):
+    # Raised at render time when citeproc-py must render the item.
+    pass
+
+class State(object):
+    __slots__ = ('language', 'repressed')
+
+    def __init__(self, language):
+        self.language = language
+        self.repressed = set()
+          # The variables of `cs:text` elements that a
+          # `cs:substitute` has already used.
+
+def reference(d):
+    ref, = CiteProcJSON([d]).values()
+    for k in DATES:
+        v = ref.get(k)
+        if isinstance(v, DateRange) or isinstance(v, Date) and not (
+                1 <= v.get('month', 1) <= 12 and 1 <= v.get('season', 1) <= 4):
+            raise Fallback
+              # Sorting a citation can render month or season
+              # terms, so a nonexistent one must go to
+              # citeproc-py, even if we wouldn't look it up.
+    return ref
+
+def tag(el):
+    return el.tag.split('}')[-1] if isinstance(el.tag, str) else None
+
+def fallback(ref, st):
+    raise Fallback
+
+def const(value):
+    return lambda ref, st: value
+
+def joiner(delimiter):
+    # Like `Delimited.join`.
+    def join(strings):
+        try:
+            return reduce(lambda a, b: a + delimiter + b,
+                [s for s in strings if s is not None])
+        except Exception:
+            return String('')
+    return join
+
+def term_text(term, plural, preformat):
+    # Like `Term.single` and `Term.multiple`.
+    child = term.find('cs:multiple' if plural else 'cs:single', term.nsmap)
+    text = term.text if child is None else child.text
+    return String(preformat(text or ''))
+
+def initialize(given, mark, hyphen):
+    # Like `Name.initialize`.
+    hyphen_parts = given.split('-') if hyphen else [given.replace('-', ' ')]
+    result_parts = []
+    for hyphen_part in hyphen_parts:
+        hyphen_result = ''
+        group = []
+        for part in hyphen_part.replace('.', ' ').split():
+            if part[0].isupper():
+                group.append(part[0])
+            else:
+                hyphen_result += mark.join(group) + mark + ' ' + part + ' '
+                group = []
+        hyphen_result += mark.join(group) + mark
+        result_parts.append(' '.join(hyphen_result.split()))
+    return '-'.join(result_parts)
+
+formatting_attributes = (
+    ('font-style', 'normal', dict(normal = None, italic = 'Italic', oblique = 'Oblique')),
+    ('font-variant', 'normal', {'normal': None, 'small-caps': 'SmallCaps'}),
+    ('font-weight', 'normal', dict(normal = None, bold = 'Bold', light = 'Light')),
+    ('text-decoration', 'none', dict(none = None, underline = 'Underline')),
+    ('vertical-align', 'baseline', dict(baseline = None, sup = 'Superscript', sub = 'Subscript')))
+
+re_multiple_numbers = Label.RE_MULTIPLE_NUMBERS
+numeric_match = Number.re_numeric.match
+
+class Compiler(object):
+    # Compiles the layout of `section` (the style's
+    # `cs:bibliography` or `cs:citation`) for items of type
+    # `item_type`. Each compiled element is a function of a
+    # `Reference` and a `State` that returns what the element's
+    # `render` method would, or raises what it would raise.
+
+    def __init__(self, section, formatter, item_type):
+        self.section = section
+        self.root = section.get_root()
+        self.formatter = formatter
+        self.preformat = formatter.preformat
+        self.type = item_type
+        self.macros = {}
+        self.in_macro = False
+          # Whether we're compiling a macro, which citeproc-py
+          # renders with a `context`.
+
+    def layout(self):
+        layout = self.section.layout
+        if layout is None:
+            raise Unsupported
+        body = self.children(layout)
+        format = self.formatting(layout)
+        prefix, suffix = layout.get('prefix', ''), layout.get('suffix', '')
+        if tag(self.section) == 'bibliography':
+            def render(ref, st):
+                return format(prefix + body(ref, st) + suffix)
+        else:
+            join = joiner(layout.get('delimiter', ''))
+            def render(ref, st):
+                output = body(ref, st)
+                out = []
+                if output is not None:
+                    out.append('' + output + '')
+                      # The cite's own prefix and suffix.
+                return format(prefix + join(out) + suffix)
+        return render
+
+    def node(self, el):
+        try:
+            return getattr(self, 'compile_' + tag(el))(el)
+        except (Unsupported, AttributeError, TypeError):
+            return fallback
+
+    def children(self, el):
+        # Like `Parent.render_children`.
+        fs = [self.node(c) for c in el]
+        def render(ref, st):
+            output = []
+            for f in fs:
+                try:
+                    text = f(ref, st)
+                    if text is not None:
+                        output.append(text)
+                except VariableError:
+                    pass
+            return reduce(add, output) if output else None
+        return render
+
+    def macro(self, name):
+        if name not in self.macros:
+            self.macros[name] = None
+              # So a recursive macro gets `Unsupported`.
+            try:
+                macro = self.root.get_macro(name)
+            except IndexError:
+                raise Unsupported
+            in_macro, self.in_macro = self.in_macro, True
+            try:
+                self.macros[name] = self.children(macro)
+            finally:
+                self.in_macro = in_macro
+        if self.macros[name] is None:
+            raise Unsupported
+        return self.macros[name]
+
+    def calls_variable(self, el):
+        # Like the elements' `calls_variable` methods.
+        t = tag(el)
+        if t == 'text':
+            if 'variable' in el.attrib:
+                return el.get('variable') not in Text.generated_variables
+            if 'macro' in el.attrib:
+                try:
+                    return self.calls_variable(self.root.get_macro(el.get('macro')))
+                except IndexError:
+                    raise Unsupported
+            return False
+        if t in ('date', 'number', 'names', 'group'):
+            return True
+        if t == 'label':
+            return el.get('variable') == 'locator'
+        if t in ('choose', 'if', 'else-if', 'else', 'macro', 'substitute'):
+            return any(self.calls_variable(c) for c in el)
+        raise Unsupported
+
+    def term(self, el, name, form = None):
+        term = el.get_term(name, form)
+        if term is None:
+            raise Unsupported
+        return term
+
+    # ------------------------------------------------------
+    # Formatting
+    # ------------------------------------------------------
+
+    def formatting(self, el):
+        # Like `Formatted.format`.
+        fs = []
+        for attr, default, choices in formatting_attributes:
+            v = el.get(attr, default)
+            if v not in choices:
+                raise Unsupported
+            if choices[v] is not None:
+                fs.append(getattr(self.formatter, choices[v]))
+        def format(string):
+            if isinstance(string, (int, float)):
+                string = str(string)
+            for f in fs:
+                string = f(string)
+            return string
+        return format
+
+    def affixes(self, el):
+        return el.get('prefix', ''), el.get('suffix', '')
+
+    def case(self, el):
+        if el.get('text-case') is None:
+            return lambda text, language = None: text
+        return lambda text, language = None: TextCased.case(el, text, language)
+
+    def strip_periods(self, el):
+        if el.get('strip-periods', 'false').lower() == 'true':
+            return lambda string: string.replace('.', '')
+        return lambda string: string
+
+    def markup(self, el):
+        # Like the `markup` methods of `cs:label`, `cs:number`, and
+        # `cs:date-part`.
+        strip, case, format = self.strip_periods(el), self.case(el), self.formatting(el)
+        prefix, suffix = self.affixes(el)
+        def markup(text):
+            if text:
+                return prefix + format(case(strip(text))) + suffix
+            return None
+        return markup
+
+    # ------------------------------------------------------
+    # Rendering elements
+    # ------------------------------------------------------
+
+    def compile_text(self, el):
+        strip, case, format = self.strip_periods(el), self.case(el), self.formatting(el)
+        prefix, suffix = self.affixes(el)
+        piq = el.get_locale_option('punctuation-in-quote')
+        if piq is None:
+            raise Unsupported
+        if el.get('quotes', 'false').lower() == 'true':
+            open_quote = term_text(self.term(el, 'open-quote'), False, self.preformat)
+            close_quote = term_text(self.term(el, 'close-quote'), False, self.preformat)
+            quote = lambda string: open_quote + string + close_quote
+        else:
+            quote = lambda string: string
+
+        if 'variable' in el.attrib:
+            get = self.variable(el)
+        elif 'macro' in el.attrib:
+            get = self.macro(el.get('macro'))
+        elif 'term' in el.attrib:
+            form = el.get('form', 'long')
+            get = const(term_text(
+                self.term(el, el.get('term'), None if form == 'long' else form),
+                el.get('plural', 'false').lower() == 'true',
+                self.preformat))
+        elif 'value' in el.attrib:
+            get = const(String(self.preformat(el.get('value'))))
+        else:
+            raise Unsupported
+
+        def render(ref, st):
+            text = get(ref, st)
+            if text:
+                return prefix + quote(format(case(strip(text), st.language))) + suffix
+            return None
+        return render
+
+    def variable(self, el):
+        # Like `Text._variable`.
+        variable = el.get('variable')
+        if (variable == 'citation-number' or
+                variable.replace('-', '_') in NAMES or
+                variable.replace('-', '_') in DATES):
+            raise Unsupported
+        short = None
+        if el.get('form') == 'short':
+            short = variable + '-short'
+        page = self.page()
+        def get(ref, st):
+            if variable in st.repressed:
+                return None
+            v = variable
+            if short is not None and short.replace('-', '_') in ref:
+                v = short
+            if v == 'page':
+                return page(ref)
+            if v == 'locator':
+                raise VariableError
+            if v == 'page-first':
+                return str(ref['page']['first'])
+            return ref[v.replace('-', '_')]
+        return get
+
+    def page(self):
+        # Like `Text._page`.
+        en_dash = self.preformat(lookup('EN DASH'))
+        range_format = self.root.get_option('page-range-format')
+        def page(ref):
+            page = ref['page']
+            str_first = str(page['first'])
+            text = str_first
+            if 'last' in page:
+                str_last = str(page['last'])
+                text += en_dash
+                if len(str_first) != len(str_last):
+                    text += str_last
+                else:
+                    text += Text._page_format_last(str_first, str_last, range_format)
+            return text
+        return page
+
+    def compile_group(self, el):
+        kids = [(self.node(c), self.calls_variable(c)) for c in el]
+        variable_called = any(cv for _, cv in kids)
+        join = joiner(el.get('delimiter', ''))
+        format = self.formatting(el)
+        prefix, suffix = self.affixes(el)
+        def render(ref, st):
+            output = []
+            variable_rendered = False
+            for f, cv in kids:
+                try:
+                    text = f(ref, st)
+                    if text is not None:
+                        output.append(text)
+                        variable_rendered = variable_rendered or cv
+                except VariableError:
+                    pass
+            if not (output and (not variable_called or variable_rendered)):
+                raise VariableError
+            text = join(output)
+            if text:
+                return prefix + format(text) + suffix
+            return None
+        return render
+
+    def compile_choose(self, el):
+        branches = []
+        for c in el:
+            t = tag(c)
+            if t in ('if', 'else-if'):
+                test = self.condition(c)
+                if test is False:
+                    continue
+                branches.append((None if test is True else test, self.children(c)))
+                if test is True:
+                    break
+            elif t == 'else':
+                branches.append((None, self.children(c)))
+                break
+            else:
+                raise Unsupported
+        def render(ref, st):
+            for test, body in branches:
+                if test is None or test(ref):
+                    return body(ref, st)
+            return None
+        return render
+
+    def condition(self, el):
+        # Like `If.render`, except that we return True or False when
+        # the type alone decides. Otherwise, we return a function of
+        # the reference.
+        static, dynamic = [], []
+        if 'type' in el.attrib:
+            static += [t.lower() == self.type for t in el.get('type').split()]
+        if 'variable' in el.attrib:
+            for v in el.get('variable').split():
+                v = v.replace('-', '_')
+                if v == 'locator':
+                    static.append(False)
+                else:
+                    dynamic.append(lambda ref, v = v: v in ref)
+        if 'is-numeric' in el.attrib:
+            for v in el.get('is-numeric').split():
+                v = v.replace('-', '_')
+                dynamic.append(lambda ref, v = v:
+                    v in ref and numeric_match(str(ref[v])))
+        uncertain = 'is-uncertain-date' in el.attrib
+        if uncertain:
+            for v in el.get('is-uncertain-date').split():
+                dynamic.append(self.uncertain_date(v.replace('-', '_')))
+        if 'position' in el.attrib:
+            if tag(self.section) != 'bibliography':
+                raise Unsupported
+            static.append(False)
+
+        if 'locator' in el.attrib:
+            def test(ref):
+                for f in dynamic:
+                    f(ref)
+                raise VariableError
+                  # There's never a locator.
+            return test
+        match = el.get('match')
+        combine = (any if match == 'any'
+            else (lambda results: not any(results)) if match == 'none'
+            else all)
+        if not dynamic:
+            return combine(static)
+        if not uncertain:
+            # The other dynamic tests can't raise exceptions, so we
+            # needn't run them when the static ones settle it.
+            if match in ('any', 'none') and any(static):
+                return match == 'any'
+            if match not in ('any', 'none') and not all(static):
+                return False
+        return lambda ref: combine(static + [f(ref) for f in dynamic])
+
+    def uncertain_date(self, v):
+        def f(ref):
+            try:
+                return ref[v].get('circa', False)
+            except VariableError:
+                return False
+        return f
+
+    def compile_names(self, el, names_context = None):
+        # Like `Names.render`.
+        nc = el if names_context is None else names_context
+        if el.get('variable') is None or nc.find('cs:et-al', nc.nsmap) is not None:
+            raise Unsupported
+        roles = el.get('variable').split()
+        name_el = nc.name
+        names = self.name(name_el)
+        label_el = nc.label
+        labels = {}
+        if label_el is not None:
+            label_first = name_el is not None and label_el is nc[0]
+              # Without a `cs:name`, citeproc-py puts a default one
+              # first.
+            form = label_el.get('form', 'long')
+            plural_option = label_el.get('plural', 'contextual')
+            markup = self.markup(label_el)
+            for role in roles + ['editortranslator']:
+                term = label_el.get_term(role, None if form == 'long' else form)
+                labels[role] = term if term is None else tuple(
+                    markup(term_text(term, plural, self.preformat))
+                    for plural in (False, True))
+                      # None, for no term, means no label.
+        ed_trans = None
+        if set(roles) == set(['editor', 'translator']):
+            ed_trans = el.get_term('editortranslator')
+            ed_trans = ed_trans if ed_trans is None else bool(ed_trans.getchildren())
+            check_ed_trans = True
+        else:
+            check_ed_trans = False
+        substitute = el.find('cs:substitute', el.nsmap)
+        substitute = substitute is not None and self.substitute(substitute, el)
+        join = joiner(el.get('delimiter', self.section.get_option('names-delimiter')))
+        format = self.formatting(el)
+        prefix, suffix = self.affixes(el)
+
+        def render(ref, st):
+            rs = roles
+            et = False
+            if check_ed_trans:
+                try:
+                    if ref['editor'] == ref['translator']:
+                        if ed_trans is None:
+                            raise Fallback
+                              # citeproc-py crashes looking up the
+                              # missing term.
+                        if ed_trans:
+                            et = True
+                            rs = ['editor']
+                except VariableError:
+                    pass
+            output = []
+            for role in rs:
+                if role in ref:
+                      # Not `role.replace('-', '_')`, so citeproc-py
+                      # never renders, e.g., "container-author".
+                    text = names(ref.get(role, []))
+                    plural = len(ref[role]) > 1
+                    if label_el is not None:
+                        label = labels[
+                            'editortranslator' if et else role]
+                        if label is not None:
+                            label = label[plural_option == 'contextual' and plural or
+                                plural_option == 'always']
+                            if label is not None:
+                                text = label + text if label_first else text + label
+                    output.append(text)
+            if output:
+                text = join(output)
+            elif substitute:
+                text = substitute(ref, st)
+            else:
+                raise VariableError
+            if text:
+                return prefix + format(text) + suffix
+            return None
+        return render
+
+    def substitute(self, el, names_el):
+        # Like `Substitute.render`.
+        kids = []
+        for child in el:
+            f = (self.compile_names(child, names_el)
+                if tag(child) == 'names' and child.name is None
+                else self.node(child))
+            kids.append((f, child.get('variable') if tag(child) == 'text' else None))
+        in_macro = self.in_macro
+        def render(ref, st):
+            text = None
+            for f, variable in kids:
+                try:
+                    text = f(ref, st)
+                except VariableError:
+                    continue
+                if text:
+                    if not in_macro:
+                        raise Fallback
+                          # citeproc-py crashes without a context.
+                    if variable is not None:
+                        st.repressed.add(variable)
+                    break
+            return text
+        return render
+
+    def name(self, el):
+        # Like `Name.render`, as a function of a list of names.
+        if el is not None and el.find('cs:name-part', el.nsmap) is not None:
+            raise Unsupported
+        attr = el.get if el is not None else (lambda name, default = None: default)
+        def option(name):
+            value = attr(name, self.section.get_option(
+                'name-' + name if name in ('form', 'delimiter') else name))
+            if name in ('initialize-with-hyphen', 'et-al-use-last'):
+                return value.lower() == 'true'
+            if name.startswith('et-al'):
+                return int(value)
+            return value
+        try:
+            and_ = option('and')
+            delimiter = option('delimiter')
+            delimiter_precedes_et_al = option('delimiter-precedes-et-al')
+            delimiter_precedes_last = option('delimiter-precedes-last')
+            et_al_min = option('et-al-min')
+            et_al_use_first = option('et-al-use-first')
+            option('et-al-subsequent-min')
+            option('et-al-subsequent-use-first')
+            et_al_use_last = option('et-al-use-last')
+            initialize_with = option('initialize-with')
+            name_as_sort_order = option('name-as-sort-order')
+            sort_separator = option('sort-separator')
+            form = option('form')
+            demote_ndp = option('demote-non-dropping-particle')
+            hyphen = option('initialize-with-hyphen')
+        except (ValueError, AttributeError):
+            raise Unsupported
+        if form not in ('long', 'short'):
+            raise Unsupported
+        if and_ == 'text':
+            and_term = term_text(self.term(self.section, 'and'), False, self.preformat)
+        elif and_ == 'symbol':
+            and_term = self.preformat('&')
+        elif and_ is not None:
+            raise Unsupported
+        et_al = term_text(self.term(self.section, 'et-al'), False, self.preformat)
+        et_al_last = et_al_use_last and et_al_use_first <= et_al_min - 2
+        ellipsis = self.preformat(lookup('horizontal ellipsis'))
+        raw_delimiter = attr('delimiter')
+        def join(strings, default):
+            return joiner(default if raw_delimiter is None else raw_delimiter)(strings)
+        format = self.formatting(el) if el is not None else (lambda string: string)
+        prefix, suffix = self.affixes(el) if el is not None else ('', '')
+        sorting = form == 'long' and name_as_sort_order in ('all', 'first')
+        demote = demote_ndp in ('never', 'sort-only')
+
+        def render(names):
+            output = []
+            et_al_truncate = (len(names) > 1 and et_al_min and
+                len(names) >= et_al_min)
+            if et_al_truncate:
+                names = (names[:et_al_use_first] + [names[-1]]
+                    if et_al_last
+                    else names[:et_al_use_first])
+            for i, name in enumerate(names):
+                given, family, dp, ndp, name_suffix = name.parts()
+                if given is not None and initialize_with is not None:
+                    given = initialize(given, initialize_with, hyphen)
+                if form == 'short':
+                    text = ' '.join([n for n in (ndp, family) if n])
+                elif sorting and (name_as_sort_order == 'all' or i == 0):
+                    if demote:
+                        family = ' '.join([n for n in (ndp, family) if n])
+                        given = ' '.join([n for n in (given, dp) if n])
+                    else:
+                        given = ' '.join([n for n in (given, dp, ndp) if n])
+                    text = sort_separator.join(
+                        [n for n in (family, given, name_suffix) if n])
+                else:
+                    family = ' '.join([n for n in (dp, ndp, family) if n])
+                    text = ' '.join([n for n in (given, family, name_suffix) if n])
+                output.append(text)
+
+            if et_al_truncate and et_al:
+                if et_al_last:
+                    output[-1] = ellipsis + ' ' + output[-1]
+                    text = join(output, delimiter)
+                elif (delimiter_precedes_et_al == 'always' or
+                        delimiter_precedes_et_al == 'contextual' and len(output) >= 2):
+                    output.append(et_al)
+                    text = join(output, delimiter)
+                else:
+                    text = join(output, delimiter) + ' ' + et_al
+            elif and_ is not None and len(output) > 1:
+                text = join(output[:-1], ', ')
+                if (delimiter_precedes_last == 'always' or
+                        delimiter_precedes_last == 'contextual' and len(output) > 2):
+                    text = join([text, ''], '')
+                else:
+                    text += ' '
+                text += '{} '.format(and_term) + output[-1]
+            else:
+                text = join(output, delimiter)
+            if text:
+                return prefix + format(text) + suffix
+            return None
+        return render
+
+    def compile_date(self, el):
+        # Like `Date.render`, for dates that aren't localized.
+        variable = el.get('variable')
+        if variable is None or el.get('form') is not None:
+            raise Unsupported
+        variable = variable.replace('-', '_')
+        parts = [self.date_part(part) for part in el
+            if part.get('name') in ('year', 'month', 'day')]
+        join = joiner(el.get('delimiter', ''))
+        prefix, suffix = self.affixes(el)
+        def render(ref, st):
+            date = ref[variable]
+            if not date:
+                return None
+            if isinstance(date, LiteralDate):
+                text = date.text
+            elif isinstance(date, DateRange):
+                raise Fallback
+            else:
+                output = []
+                for f in parts:
+                    try:
+                        part_text = f(date)
+                        if part_text is not None:
+                            output.append(part_text)
+                    except VariableError:
+                        pass
+                text = join(output) if output else None
+            if text is not None:
+                return prefix + text + suffix
+            return None
+        return render
+
+    def date_part(self, el):
+        # Like `Date_Part.render`.
+        name = el.get('name')
+        markup = self.markup(el)
+        if name == 'year':
+            form = el.get('form', 'long')
+            if form == 'long':
+                bc = term_text(self.term(el, 'bc'), False, self.preformat)
+                ad = term_text(self.term(el, 'ad'), False, self.preformat)
+                def text(date):
+                    text = str(abs(date.year))
+                    if date.year < 0:
+                        text += bc
+                    elif date.year < 1000:
+                        text += ad
+                    return text
+            elif form == 'short':
+                text = lambda date: str(date.year)[-2:]
+            else:
+                raise Unsupported
+        elif name == 'month':
+            form = el.get('form', 'long')
+            if form in ('long', 'short'):
+                terms = {}
+                for term, n in (('month', 12), ('season', 4)):
+                    for index in range(1, n + 1):
+                        t = el.get_term('{}-{:02}'.format(term, index),
+                            None if form == 'long' else form)
+                        terms[term, index] = t if t is None else term_text(t, False, self.preformat)
+                def text(date):
+                    try:
+                        k = 'month', date.month
+                    except VariableError:
+                        k = 'season', date.season
+                    if terms[k] is None:
+                        raise Fallback
+                    return terms[k]
+            elif form in ('numeric', 'numeric-leading-zeros'):
+                pattern = '{}' if form == 'numeric' else '{:02}'
+                def text(date):
+                    try:
+                        return pattern.format(date.month)
+                    except VariableError:
+                        date.season
+                        raise Fallback
+            else:
+                raise Unsupported
+        elif name == 'day':
+            form = el.get('form', 'numeric')
+            if form == 'numeric':
+                text = lambda date: date.day
+            elif form == 'numeric-leading-zeros':
+                text = lambda date: '{:02}'.format(date.day)
+            else:
+                raise Unsupported
+        else:
+            raise Unsupported
+        return lambda date: markup(text(date))
+
+    def compile_number(self, el):
+        # Like `Number.render`.
+        form = el.get('form', 'numeric')
+        variable = el.get('variable')
+        if form not in ('numeric', 'ordinal') or variable is None:
+            raise Unsupported
+        ordinals = {}
+        for i in range(1, 5):
+            t = el.get_term('ordinal-{:02}'.format(i))
+            ordinals[i] = t if t is None else term_text(t, False, self.preformat)
+        def format_number(number):
+            if form == 'numeric':
+                return str(number)
+            number = str(number)
+            last_digit = int(number[-1])
+            if last_digit in (1, 2, 3) and not (len(number) > 1 and number[-2] == '1'):
+                term = ordinals[last_digit]
+            else:
+                term = ordinals[4]
+            if term is None:
+                raise AttributeError
+                  # As `to_ordinal` would.
+            return number + term
+        en_dash = self.preformat(lookup('EN DASH'))
+        markup = self.markup(el)
+        def render(ref, st):
+            if variable == 'locator':
+                raise VariableError
+            elif variable == 'page-first':
+                value = ref['page']['first']
+            else:
+                value = ref[variable]
+            try:
+                first, last = map(int, Number.re_range.match(str(value)).groups())
+                text = format_number(first) + en_dash + format_number(last)
+            except AttributeError:
+                try:
+                    text = format_number(int(numeric_match(str(value)).group(1)))
+                except AttributeError:
+                    text = value
+            except TypeError:
+                text = str(value)
+            return markup(text)
+        return render
+
+    def compile_label(self, el):
+        # Like `Label.render`, outside of `cs:names`.
+        variable = el.get('variable')
+        if variable is None:
+            raise Unsupported
+        form = el.get('form', 'long')
+        plural_option = el.get('plural', 'contextual')
+        term = el.get_term(variable, None if form == 'long' else form)
+        markup = self.markup(el)
+        texts = term is not None and [
+            markup(term_text(term, plural, self.preformat))
+            for plural in (False, True)]
+        key = variable.replace('-', '_')
+        def render(ref, st):
+            if variable == 'locator':
+                raise VariableError
+            try:
+                value = ref[key]
+            except VariableError:
+                plural = False
+            else:
+                if variable.startswith('number-of'):
+                    raise VariableError
+                      # citeproc-py looks for the variable in the
+                      # cite instead of the reference.
+                plural = re_multiple_numbers.search(str(value)) is not None
+            if texts is False:
+                raise Fallback
+            return texts[plural_option == 'contextual' and plural or
+                plural_option == 'always']
+        return render
@@ -1,36 +1,21 @@
 # -*- Python -*-
 
-from os import environ
+from os import environ, utime
+import json, re
+import pytest
+import quickbib
 from quickbib import bib, name
+from csl_fixtures import merge_dicts, dashed, jf
 
 if 'APA_CSL_PATH' not in environ:
     raise Exception('The environment variable APA_CSL_PATH is not set')
 
-def f(ds, multi = False, **kw):
+def f(ds, multi = False, style_path = None, **kw):
     if not multi: ds = [ds]
-    ds = [
-        {k.replace('_', '-'): v for k, v in d.items()}
-        for d in ds]
-    bibl = bib(environ['APA_CSL_PATH'], ds, apa_tweaks = True, **kw)
+    ds = [dashed(d) for d in ds]
+    bibl = bib(style_path or environ['APA_CSL_PATH'], ds, apa_tweaks = True, **kw)
     return bibl if multi else bibl[0]
 
-def merge_dicts(d1, d2):
-    return dict(list(d1.items()) + list(d2.items()))
-
-def jf(**field_kws):
-    return merge_dicts(
-        dict(type = 'article-journal',
-            author =
-                [name('Joesph', 'Bloggs'),
-                name('J. Random', 'Hacker')],
-            issued = {'date-parts': [[1983]]},
-            title = 'The main title',
-            container_title = 'Sciency Times',
-            volume = '30', issue = '7',
-            page = '293–315',
-            DOI = '10.zzz/zzzzzz'),
-        field_kws)
-
 def j(o = None, **field_kws):
     if o is None: o = {}
     return f(jf(**field_kws), **o)
@@ -122,6 +107,34 @@ def test_sorting():
         'Bloggs, J., & Hacker, J. R. (1983b). Quails. <i>Sciency Times, 30</i>, 293–315. doi:10.zzz/zzzzzz',
         'Bloggs, J., & Hacker, J. R. (1984). The main title. <i>Sciency Times, 30</i>, 293–315. doi:10.zzz/zzzzzz']
 
+def test_collation():
+    l = [jf(author = [name('Anders', 'Ångström')]),
+        jf(author = [name('Bell', 'Azerty')]),
+        jf(author = [name('Bell', 'Zed')])]
+    first = lambda bibl: [e.split(',')[0] for e in bibl]
+    assert first(f(l, multi = True)) == ['Azerty', 'Zed', 'Ångström']
+    assert first(f(l, multi = True, collation = 'accents')) == ['Ångström', 'Azerty', 'Zed']
+    assert first(f(l, multi = True, collation = lambda s: s[::-1])) == ['Zed', 'Ångström', 'Azerty']
+    assert quickbib.sort_key(
+            dashed(jf(title = 'A Title')),
+            quickbib.fold_accents) == (
+        (('bloggs', 'j'), ('hacker', 'j')), 1983, 'title', 293)
+
+def test_bytes_collation():
+    l = [jf(author = [name('Bell', 'Azerty')]),
+        jf(author = [dict(family = 'Azerty')])]
+    assert [e.split('(')[0] for e in f(l, multi = True,
+        collation = lambda s: s.lower().encode('UTF-8'))] == ['Azerty. ', 'Azerty, B. ']
+
+def test_string_years():
+    l = [jf(author = [name('Aaa', 'Alfa')], issued = {'date-parts': [[y]]})
+        for y in ('2001', 990, '1990')]
+    years = lambda bibl: [re.search(r'\((\d+)', e).group(1) for e in bibl]
+    assert years(f(l, multi = True)) == ['990', '1990', '2001']
+    for d in l:
+        d['issued']['date-parts'][0][0] = str(d['issued']['date-parts'][0][0])
+    assert years(f(l, multi = True)) == ['990', '1990', '2001']
+
 def test_duplicate_tracking():
     l = [
        jf(author = [name('Aaa', 'Alfa')]),
@@ -139,6 +152,28 @@ def test_duplicate_tracking():
       # suffixes because they would be cited inline with both
       # authors, instead of just Alfa as the others would be.
 
+def test_same_id():
+    l = [jf(id = 'x', title = 'First'),
+        jf(id = 'y', author = [name('Aaa', 'Alfa')]),
+        jf(id = 'X', title = 'Second')]
+    assert f(l, multi = True) == [
+        'Alfa, A. (1983). The main title. <i>Sciency Times, 30</i>, 293–315. doi:10.zzz/zzzzzz',
+        'Bloggs, J., & Hacker, J. R. (1983). Second. <i>Sciency Times, 30</i>, 293–315. doi:10.zzz/zzzzzz']
+      # Keys are case-insensitive, and the last item with a key
+      # wins, as in citeproc-py.
+    assert f(l[::2], multi = True, formatter = 'plain') == [
+        'Bloggs, J., & Hacker, J. R. (1983). Second. Sciency Times, 30, 293–315. doi:10.zzz/zzzzzz']
+
+def test_same_id_stream():
+    l = [dashed(d) for d in [
+        jf(id = 'x', title = 'First'),
+        jf(id = 'y', author = [name('Aaa', 'Alfa')]),
+        jf(id = 'X', title = 'Second'),
+        jf(id = 'y', author = [name('Ccc', 'Charlie')])]]
+    for chunk_size in (1, 10):
+        assert list(quickbib.bib_stream(environ['APA_CSL_PATH'], l,
+            chunk_size = chunk_size)) == bib(environ['APA_CSL_PATH'], l)
+
 def test_report():
 # Technical report
     def r(publisher_website):
@@ -306,3 +341,506 @@ def test_software():
             version = '2.4.0',
             URL = 'http://mc-stan.org')) ==
         'Stan Development Team. (2014). Stan: A C++ library for probability and sampling (Version 2.4.0) [Software]. Retrieved from http://mc-stan.org')
+
+def test_style_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(quickbib, 'style_cache', {})
+    style_path = tmpdir.join('style.csl')
+    style_path.write_text(open(environ['APA_CSL_PATH'], encoding = 'UTF-8').read(),
+        encoding = 'UTF-8')
+    expected = j()
+    assert f(jf(), style_path = str(style_path)) == expected
+    style = quickbib.get_style(str(style_path), True, False, False, True)
+    assert quickbib.get_style(str(style_path), True, False, False, True) is style
+    style_path.write_text(style_path.read_text('UTF-8').replace(
+        '<macro name="container-title">', '<macro name="container-title">\n'),
+        encoding = 'UTF-8')
+    utime(str(style_path), ns = (0, 0))
+      # In case the file system's clock is coarse.
+    assert quickbib.get_style(str(style_path), True, False, False, True) is not style
+    assert f(jf(), style_path = str(style_path)) == expected
+      # Editing the style invalidates the entry.
+
+def test_incremental_bibliography():
+    from quickbib import Bibliography
+    def ids(*ds):
+        return [dict(d, id = str(i)) for i, d in enumerate(ds)]
+    l = ids(jf(), jf(author = [name('Aaa', 'Alfa')]), jf(title = 'Quails'))
+    b = Bibliography(environ['APA_CSL_PATH'], l[:2])
+    assert b.bibliography() == f(l[:2], multi = True)
+    assert b.add(l[2]) == {
+        '0': 'Bloggs, J., & Hacker, J. R. (1983a). The main title. <i>Sciency Times, 30</i>, 293–315. doi:10.zzz/zzzzzz',
+        '2': 'Bloggs, J., & Hacker, J. R. (1983b). Quails. <i>Sciency Times, 30</i>, 293–315. doi:10.zzz/zzzzzz'}
+      # Adding a work by the same authors gives the old one a suffix.
+    assert b.bibliography() == f(l, multi = True)
+    assert b.update(dict(l[2], title = 'Aardvarks')) == {
+        '0': 'Bloggs, J., & Hacker, J. R. (1983b). The main title. <i>Sciency Times, 30</i>, 293–315. doi:10.zzz/zzzzzz',
+        '2': 'Bloggs, J., & Hacker, J. R. (1983a). Aardvarks. <i>Sciency Times, 30</i>, 293–315. doi:10.zzz/zzzzzz'}
+    assert b.remove('2') == {
+        '0': 'Bloggs, J., & Hacker, J. R. (1983). The main title. <i>Sciency Times, 30</i>, 293–315. doi:10.zzz/zzzzzz',
+        '2': None}
+    assert b.keys() == ['1', '0']
+
+def test_year_suffixes():
+    titles = ['Title {:02d}'.format(i) for i in range(30)]
+    bibl = f([jf(title = t) for t in reversed(titles)], multi = True)
+    assert [e.split(' (')[1][:len('1983aa')].rstrip(')') for e in bibl] == (
+        ['1983' + c for c in 'abcdefghijklmnopqrstuvwxyz'] +
+        ['1983aa', '1983ab', '1983ac', '1983ad'])
+
+    index = quickbib.YearSuffixes()
+    def add(*items):
+        return index.add((d_id, d, quickbib.sort_key(d)) for d_id, d in items)
+    ds = {str(i): dashed(jf(title = t))
+        for i, t in enumerate(titles[:3])}
+    assert add(*ds.items()) == {'0', '1', '2'}
+    assert index.suffixes() == {'0': 'a', '1': 'b', '2': 'c'}
+    other = dashed(jf(author = [name('Aaa', 'Alfa')]))
+    assert add(('x', other)) == {'x'}
+    assert index.suffix('x') is None
+    assert add(('y', dict(ds['1'], title = 'Title 00'))) == {'1', '2', 'y'}
+      # Ties in title go by order of addition.
+    assert index.suffixes() == {'0': 'a', 'y': 'b', '1': 'c', '2': 'd'}
+    assert index.remove(['0', '1']) == {'y', '2'}
+    assert index.suffixes() == {'y': 'a', '2': 'b'}
+    assert quickbib.suffix_letters(26 + 26 * 26) == 'aaa'
+
+def test_entry_cache(tmpdir, monkeypatch):
+    store_path = str(tmpdir.join('entries.sqlite'))
+    monkeypatch.setattr(quickbib, 'entry_cache',
+        quickbib.EntryCache(maxsize = 2, store_path = store_path))
+    l = [jf(title = 'Quails'), jf(), jf(author = [name('Aaa', 'Alfa')])]
+    expected = f(l, multi = True)
+    assert quickbib.entry_cache.stats() == dict(
+        hits = 0, misses = 3, evictions = 1, store_hits = 0, size = 2)
+    assert f(l, multi = True, return_cites_and_keys = True)[2] == expected
+    assert quickbib.entry_cache.stats() == dict(
+        hits = 3, misses = 3, evictions = 4, store_hits = 3, size = 2)
+      # Cycling through three items defeats a two-item LRU
+      # cache, so every entry comes back from the store.
+    monkeypatch.setattr(quickbib, 'entry_cache',
+        quickbib.EntryCache(store_path = store_path))
+    assert f(l, multi = True) == expected
+    assert quickbib.entry_cache.stats() == dict(
+        hits = 3, misses = 0, evictions = 0, store_hits = 3, size = 3)
+      # A new cache (as in a new process) reads the same store.
+
+def test_batch():
+    def job(command, **args):
+        return dict(command = command,
+            args = dict(args, style_path = environ['APA_CSL_PATH']))
+    d = dashed(jf())
+    replies = quickbib.batch([
+        job('bib1', d = d),
+        job('bib', ds = [d, dict(d, title = 'Quails')]),
+        job('bib1', d = dict(d, title = 'Quails')),
+        job('bib1', d = d, always_include_issue = True),
+        job('bib1', d = dict(d, type = None)),
+        job('frob')])
+    assert replies[:4] == [
+        {'value': j()},
+        {'value': [
+            'Bloggs, J., & Hacker, J. R. (1983a). The main title. <i>Sciency Times, 30</i>, 293–315. doi:10.zzz/zzzzzz',
+            'Bloggs, J., & Hacker, J. R. (1983b). Quails. <i>Sciency Times, 30</i>, 293–315. doi:10.zzz/zzzzzz']},
+        {'value': j(title = 'Quails')},
+        {'value': j(o = {'always_include_issue': True})}]
+    assert replies[4] == {'error': "KeyError: 'type'"}
+    assert replies[5] == {'error': 'Illegal command: frob'}
+
+def test_batch_options(monkeypatch):
+    handled = []
+    monkeypatch.setattr(quickbib, 'handle',
+        lambda job, stats: handled.append(job))
+    d = dashed(jf())
+    replies = quickbib.batch([
+        dict(command = 'bib1', args = dict(
+            style_path = environ['APA_CSL_PATH'], d = d, **o))
+        for o in [{}, dict(return_cites_and_keys = False),
+            dict(dedup = True), dict(workers = 2)]])
+      # None of these should fall back on `handle`.
+    assert not handled
+    assert replies == [{'value': j()}] * 4
+
+def test_batch_malformed():
+    good = dict(command = 'bib1', args = dict(
+        style_path = environ['APA_CSL_PATH'], d = dashed(jf())))
+    replies = quickbib.batch([dict(command = 'bib1'), good,
+        dict(command = 'bib1', args = 'frob'), dict(args = {}), good])
+    assert replies[1] == replies[4] == {'value': quickbib.bib1(**good['args'])}
+    assert all('error' in replies[i] for i in (0, 2, 3))
+
+def test_postprocessing_rules():
+    def old_postprocess(s, formatter, apa_tweaks):
+        s = s.replace('  ', ' ')
+        s = re.sub(r'([.!?…])\.', r'\1', s)
+        if apa_tweaks:
+            if formatter in ('html', 'chocolate'):
+                s = re.sub(r'</i>, <i>(\d)', r', \1', s)
+                s = re.sub(r'([.!?…]</i>)\.', r'\1', s)
+            s = re.sub('^([^.,]+), &', r'\1 &', s)
+        return s
+    entries = [
+        'Plato, & Hacker, J. R. (1983). Main title.. Elsewhere.',
+        'Plato?., & Hacker, J. R. (1983). Is it?</i>.. <i>X</i>, <i>30</i>, 1.',
+        'Bloggs, J.,  &   Hacker, J. R. (1983). Quails!</i>. Done…. ',
+        'Aristotle, & Plato, &  Socrates.',
+        'No punctuation at all, & friends',
+        '',
+        '. , & ...... !!.. ?</i>.</i>.']
+    style = quickbib.get_style(environ['APA_CSL_PATH'], True, False, False, True)
+    for formatter in ('chocolate', 'html', 'plain'):
+        for apa_tweaks in (True, False):
+            expected = [old_postprocess(e, formatter, apa_tweaks) for e in entries]
+            f = quickbib.get_formatter(formatter)
+            assert quickbib.postprocess(entries, style, f, apa_tweaks) == expected
+            assert [quickbib.postprocess([e], style, f, apa_tweaks)[0]
+                for e in entries] == expected
+            assert quickbib.postprocess(entries + ['Two\nlines, & x'],
+                style, f, apa_tweaks)[:-1] == expected
+
+    try:
+        quickbib.register_rules('shouting', quickbib.apa_rules + [('title', 'TITLE')],
+            [style.root.info.id.text])
+        assert j() == 'Bloggs, J., & Hacker, J. R. (1983). The main TITLE. <i>Sciency Times, 30</i>, 293–315. doi:10.zzz/zzzzzz'
+    finally:
+        quickbib.style_rule_sets.clear()
+        quickbib.compiled_rules.clear()
+    assert j() == 'Bloggs, J., & Hacker, J. R. (1983). The main title. <i>Sciency Times, 30</i>, 293–315. doi:10.zzz/zzzzzz'
+
+def test_stats():
+    d = dashed(jf())
+    ds = [d, dict(d, title = 'Quails')]
+    stats = quickbib.Stats()
+    quickbib.entry_cache.clear()
+    bib(environ['APA_CSL_PATH'], ds, stats = stats)
+    bib(environ['APA_CSL_PATH'], ds, stats = stats)
+    s = stats.as_dict()
+    assert s['phases']['style']['calls'] == 2
+    assert s['phases']['disambiguation']['items'] == 4
+    assert s['phases']['sorting']['calls'] == 2
+    assert s['counters']['style cache hits'] >= 1
+    assert s['counters']['entry cache misses'] == 2
+    assert s['counters']['entry cache hits'] == 2
+    assert all(p['seconds'] >= 0 for p in s['phases'].values())
+
+    o = dict(command = 'bib1', stats = True,
+        args = dict(style_path = environ['APA_CSL_PATH'], d = d))
+    r = quickbib.finish(o, quickbib.handle(o))
+    assert r['value'] == j()
+    assert r['stats']['phases']['style']['calls'] == 1
+    del o['stats']
+    assert 'stats' not in quickbib.finish(o, quickbib.handle(o))
+    r = quickbib.handle(dict(command = 'stats'))
+    assert r['value']['phases']['style']['calls'] >= 2
+
+def test_stream(tmpdir):
+    l = [dashed(d) for d in [
+       jf(title = 'Quails'),
+       jf(author = [name('Bell', 'azerty')]),
+       jf(),
+       jf(issued = {'date-parts': [[1984]]}),
+       jf(author = [name('Joesph', 'Aloggs'), name('J. Random', 'Hacker')]),
+       jf(author = [name('Aaa', 'Alfa'), name('Bbb', 'Bravo')]),
+       jf(author = [name('Aaa', 'Alfa'), name('Bbb', 'Bravo')], title = 'Another title')]]
+    expected = f(l, multi = True)
+    assert list(quickbib.bib_stream(environ['APA_CSL_PATH'], l, chunk_size = 2)) == expected
+    path = tmpdir.join('items.jsonl')
+    path.write_text(''.join(json.dumps(d) + '\n' for d in l), encoding = 'UTF-8')
+    assert list(quickbib.bib_stream(environ['APA_CSL_PATH'], str(path), chunk_size = 3)) == expected
+
+def test_parallel(monkeypatch):
+    monkeypatch.setattr(quickbib, 'entry_cache', None)
+    l = [jf(title = 'Title {}'.format(i), author = [name('Aaa', 'Alfa{}'.format(i % 3))])
+        for i in range(12)]
+    assert (f(l, multi = True, workers = 3, return_cites_and_keys = True) ==
+        f(l, multi = True, return_cites_and_keys = True))
+
+def test_input_unchanged():
+    from copy import deepcopy
+    l = [dashed(d) for d in [
+        jf(author = [name('Mary-jane', 'Sally')]),
+        jf(DOI = None),
+        dict(type = 'report', author = [name('Anna', 'Dreber')],
+            issued = {'date-parts': [[2010]]}, title = 'Beauty queens',
+            publisher = 'Institute for the Study of Labor',
+            URL = 'http://ftp.iza.org/dp5314.pdf')]]
+    original = deepcopy(l)
+    f(l, multi = True)
+    assert l == original
+
+def test_lazy_imports():
+    import subprocess, sys
+    from os.path import dirname
+    assert subprocess.check_output([sys.executable, '-c',
+        'import sys, quickbib; print("citeproc" in sys.modules)'],
+        cwd = dirname(quickbib.__file__) or '.',
+        universal_newlines = True).strip() == 'False'
+    quickbib.preload([environ['APA_CSL_PATH']])
+    assert f(jf()) == f(jf())
+
+def test_renderer_cache(monkeypatch):
+    monkeypatch.setattr(quickbib, 'entry_cache', None)
+    l = [jf(), jf(title = 'Another title', author = [name('Aaa', 'Alfa')])]
+    html = f(l, multi = True, formatter = 'html')
+    plain = f(l, multi = True, formatter = 'plain')
+    assert html != plain
+    assert f(l, multi = True, formatter = 'html') == html
+    assert f(l[1], formatter = 'plain') == plain[0]
+    style = quickbib.get_style(environ['APA_CSL_PATH'], True, False, False, True)
+    assert {'html', 'plain'} <= {quickbib.formatter_name(fm) for fm in style.renderers}
+    assert all(not r.source and not r.bibliography.items
+        for r in style.renderers.values())
+      # Idle renderers don't hold on to items.
+
+def test_render_chunks(monkeypatch):
+    monkeypatch.setattr(quickbib, 'entry_cache', None)
+    l = [jf(title = 'Title {}'.format(i), author = [name('Aaa', 'Alfa{}'.format(i % 3))])
+        for i in range(7)]
+    expected = f(l, multi = True, return_cites_and_keys = True)[::2]
+    monkeypatch.setattr(quickbib, 'render_chunk_size', 2)
+    assert f(l, multi = True, return_cites_and_keys = True)[::2] == expected
+
+def test_async_client():
+    import asyncio
+    from os import kill
+    from signal import SIGKILL
+    from quickbib_client import Client, Error
+    l = [dashed(jf(title = 'Title {}'.format(i)))
+        for i in range(6)]
+    async def main():
+        async with Client(processes = 2, timeout = 60) as client:
+            entries = await asyncio.gather(*(
+                client.bib1(environ['APA_CSL_PATH'], d, apa_tweaks = True) for d in l))
+            assert entries == [f(d) for d in l]
+            with pytest.raises(Error):
+                await client.bib1(environ['APA_CSL_PATH'], dict(title = 'No type'))
+            kill(client.servers[0].process.pid, SIGKILL)
+            assert await asyncio.gather(*(
+                client.bib1(environ['APA_CSL_PATH'], d, apa_tweaks = True) for d in l)) == entries
+              # The dead server is replaced.
+            for s in client.servers:
+                s.decode = lambda b: 1 / 0
+            assert await client.bib1(environ['APA_CSL_PATH'], l[0], apa_tweaks = True) == entries[0]
+              # A server whose reply can't be read is replaced, too.
+            assert all('phases' in s for s in await client.stats())
+        async with Client() as client:
+            orphan = client.servers[0].pending[-1] = asyncio.get_running_loop().create_future()
+        with pytest.raises(Error):
+            await asyncio.wait_for(orphan, 10)
+          # Requests still waiting when the server exits fail.
+    asyncio.run(main())
+
+def test_framing():
+    from io import BytesIO
+    d = dashed(jf(title = 'Ångström’s “lines”'))
+    request = dict(command = 'bib1', args = dict(style_path = environ['APA_CSL_PATH'],
+        d = d, apa_tweaks = True), id = 1)
+    lines, framed = quickbib.Framing(), quickbib.Framing('json')
+    rfile, wfile = BytesIO(), BytesIO()
+    lines.write(rfile, dict(command = 'framing', args = dict(codecs = ['nonesuch', 'json'])))
+    framed.write(rfile, request)
+    framed.write(rfile, dict(command = 'quit'))
+    rfile.seek(0)
+    quickbib.serve(rfile, wfile)
+    wfile.seek(0)
+    assert lines.read(wfile) == {'value': 'json'}
+    raw = wfile.read()
+    assert 'Ångström’s'.encode('UTF-8') in raw
+    assert framed.read(BytesIO(raw)) == {'value': f(d), 'id': 1}
+
+def test_cites(monkeypatch):
+    monkeypatch.setattr(quickbib, 'cite_cache', quickbib.EntryCache())
+    l = [dashed(d) for d in [
+        jf(title = 'Title {}'.format(i), author = [name('Aaa', 'Alfa{}'.format(i % 3))])
+        for i in range(5)]]
+    l = [dict(d, id = 'i{}'.format(i)) for i, d in enumerate(l)]
+    expected = bib(environ['APA_CSL_PATH'], l, return_cites_and_keys = True)[:2]
+    assert [''.join(c) for c in expected[0][:2]] == ['(Alfa0, 1983a)', '(Alfa1, 1983a)']
+    assert quickbib.cites(environ['APA_CSL_PATH'], l) == expected
+    stats = quickbib.Stats()
+    assert quickbib.cites(environ['APA_CSL_PATH'], l, stats = stats) == expected
+    assert stats.counters['cite cache hits'] == 5
+    cites, keys = quickbib.cites(environ['APA_CSL_PATH'], l[:1])
+    assert ''.join(cites[0]) == '(Alfa0, 1983)' and keys == ['i0']
+      # A different year suffix means a different citation.
+
+def test_bib_multi(monkeypatch):
+    monkeypatch.setattr(quickbib, 'entry_cache', quickbib.EntryCache())
+    l = [dashed(d) for d in [
+        jf(title = 'Title {}'.format(i), author = [name('Aaa', 'Alfa{}'.format(i % 3))])
+        for i in range(5)]]
+    l = [dict(d, id = 'i{}'.format(i)) for i, d in enumerate(l)]
+    targets = dict(
+        html = (environ['APA_CSL_PATH'], 'html', {}),
+        plain = (environ['APA_CSL_PATH'], 'plain', dict(return_cites_and_keys = True)),
+        untweaked = (environ['APA_CSL_PATH'], 'plain', dict(apa_tweaks = False)))
+    expected = {k: bib(p, l, formatter = formatter, **options)
+        for k, (p, formatter, options) in targets.items()}
+    assert quickbib.bib_multi(l, targets) == expected
+    assert quickbib.bib_multi(l, list(targets.values()), workers = 2) == list(expected.values())
+    with pytest.raises(TypeError):
+        quickbib.bib_multi(l, [(environ['APA_CSL_PATH'], 'html', dict(title = 'x'))])
+
+def test_dedup():
+    l = [dashed(d) for d in [
+        jf(),
+        jf(title = 'Quails', DOI = 'https://doi.org/10.ZZZ/Quails'),
+        jf(title = 'Quails', DOI = '10.zzz/quails', volume = '31'),
+        jf(title = 'The  main title!', DOI = None),
+        jf(title = 'Quails', DOI = '10.zzz/other'),
+        dict(type = 'book', author = [name('Aaa', 'Alfa')], title = 'A book',
+            issued = {'date-parts': [[2001]]}, ISBN = '0-306-40615-2'),
+        dict(type = 'book', author = [name('Aaa', 'Alfa')], title = 'A book (2nd ed.)',
+            issued = {'date-parts': [[2002]]}, ISBN = '978-0-306-40615-7'),
+        jf()]]
+    assert quickbib.duplicates(l) == [[0, 3, 7], [1, 2], [5, 6]]
+    assert 'id' not in l[0]
+    _, keys, _ = bib(environ['APA_CSL_PATH'], l, return_cites_and_keys = True)
+    assert keys == bib(environ['APA_CSL_PATH'], l, return_cites_and_keys = True)[1]
+      # The IDs made for items without one are the same every time.
+    stats = quickbib.Stats()
+    cites, keys, bibl = bib(environ['APA_CSL_PATH'], l, return_cites_and_keys = True,
+        dedup = True, stats = stats)
+    assert len(bibl) == len(keys) == 4 and stats.counters['duplicates'] == 4
+    assert cites[1] == cites[2] and cites[5] == cites[6] and cites[1] != cites[4]
+
+def test_copies_without_ids():
+    d = dashed(jf())
+    cites, keys, bibl = bib(environ['APA_CSL_PATH'], [d, dict(d)],
+        return_cites_and_keys = True)
+    assert len(set(keys)) == len(bibl) == 2
+    assert [re.search(r'\(\d+\w*\)', e).group() for e in bibl] == ['(1983a)', '(1983b)']
+    assert ''.join(cites[0]) != ''.join(cites[1])
+      # Identical items without IDs are still separate works,
+      # as they were when their IDs were random.
+    cites, keys, bibl = bib(environ['APA_CSL_PATH'], [d, dict(d)],
+        return_cites_and_keys = True, dedup = True)
+    assert len(keys) == len(bibl) == 1 and cites[0] == cites[1]
+    assert quickbib.duplicates([d, dict(d)]) == [[0, 1]]
+
+def test_ris(tmpdir):
+    import citematic_ris
+    ris = '''Provider: Somebody
+
+TY  - JOUR
+T1  - Should flood insurance be mandatory? Insights in the wake of the 1997 New Year’s Day flood
+JO  - Applied Geography
+VL  - 21
+IS  - 03
+SP  - 199
+EP  - 221
+PY  - 2001/7//
+AU  - Blanchard-Boehm, R.D
+AU  - Berry, K.A
+DO  - http://dx.doi.org/10.1016/S0143-6228(01)00009-1
+UR  - http://www.sciencedirect.com/science/article/pii/S0143622801000091
+KW  - Flood insurance decision
+ER  - 
+
+TY  - BOOK
+TI  - Not a journal article
+ER  - 
+
+TY  - JOUR
+A1  - Crosby, Everett U.
+T1  - Fire Prevention
+Y1  - 1905/09/01 
+JF  - The ANNALS of the American Academy of Political and Social Science 
+SP  - 224-238 
+M3  - 10.1177/000271620502600215 
+VL  - 26 
+ER  - 
+'''
+    path = tmpdir.join('items.ris')
+    path.write_text(ris, encoding = 'UTF-8')
+    with pytest.raises(ValueError):
+        list(citematic_ris.items(str(path)))
+    l = list(citematic_ris.items(str(path), skip_bad = True))
+    assert l == [
+        {'type': 'article-journal',
+            'author': [name('R. D.', 'Blanchard-Boehm'), name('K. A.', 'Berry')],
+            'issued': {'date-parts': [['2001']]},
+            'title': "Should flood insurance be mandatory? Insights in the wake of the 1997 New Year's Day flood",
+            'container-title': 'Applied Geography',
+            'volume': '21', 'issue': '3', 'page': '199–221',
+            'DOI': '10.1016/S0143-6228(01)00009-1'},
+        {'type': 'article-journal',
+            'author': [name('Everett U.', 'Crosby')],
+            'issued': {'date-parts': [['1905']]},
+            'title': 'Fire prevention',
+            'container-title': 'The ANNALS of the American Academy of Political and Social Science',
+            'volume': '26', 'page': '224–238',
+            'DOI': '10.1177/000271620502600215'}]
+    path.write_text(ris.replace('TY  - BOOK', 'TY  - JOUR\nPY  - 2000\nAU  - Doe, Jane'),
+        encoding = 'UTF-8')
+    assert (list(quickbib.bib_stream(environ['APA_CSL_PATH'], str(path))) ==
+        f(list(citematic_ris.items(str(path))), multi = True))
+
+def test_database(tmpdir):
+    from citematic_db import Database
+    source = tmpdir.join('db.json')
+    source.write(json.dumps([
+        dict(KEY = 'a', csl = dict(title = 'A1')),
+        dict(KEY = 'b', csl = dict(title = 'B')),
+        dict(KEY = 'a', csl = dict(title = 'A2'))]))
+    db = Database(str(source), str(tmpdir.join('store.sqlite')))
+    assert len(db) == 2
+    assert db['a']['csl']['title'] == 'A2'
+    assert [x['KEY'] for x in db] == ['b', 'a']
+    rendered = []
+    def render_many(xs):
+        for x in xs:
+            rendered.append(x['KEY'])
+            yield x['csl']['title']
+    assert list(db.outputs('t', render_many)) == [('b', 'B'), ('a', 'A2')]
+    assert list(db.outputs('t', render_many)) == [('b', 'B'), ('a', 'A2')]
+    assert rendered == ['b', 'a']
+
+def test_compiled(monkeypatch):
+    monkeypatch.setattr(quickbib, 'entry_cache', None)
+    monkeypatch.setattr(quickbib, 'cite_cache', None)
+    l = [dashed(d) for d in [
+        jf(),
+        jf(DOI = None, URL = 'http://example.com', issue = None),
+        jf(author = [name(c*2, c.upper()+'lpha') for c in 'abcdefgh'], title = 'But why?'),
+        jf(author = [name('Mary-Jane', 'Sally')], page = 'S15–Z90'),
+        dict(type = 'book', author = [name('John Quixote', 'Doe')], title = 'A book',
+            issued = {'date-parts': [[2001]]}, edition = '2',
+            publisher = 'Ric-Rac Press', publisher_place = 'Tuscon, AZ'),
+        dict(type = 'book', editor = [name('John Quixote', 'Doe')], title = 'A book',
+            issued = {'date-parts': [[2001]]}, ISBN = '0123456789'),
+        dict(type = 'chapter', author = [name('Aaa', 'Alfa')], title = 'A chapter',
+            editor = [name('John Quixote', 'Doe'), name('Richard X.', 'Roe')],
+            container_title = 'The book of love', page = '12–15',
+            issued = {'date-parts': [[1999, 5]]}, publisher = 'Ric-Rac Press'),
+        dict(type = 'report', author = [name('Anna', 'Dreber')], title = 'Beauty queens',
+            issued = {'date-parts': [[2010]]})]]
+    for formatter in ('html', 'plain'):
+        monkeypatch.setattr(quickbib, 'compiled_types', ())
+        expected = f(l, multi = True, formatter = formatter, return_cites_and_keys = True)
+        expected_cites = quickbib.cites(environ['APA_CSL_PATH'], l, formatter = formatter)
+        monkeypatch.setattr(quickbib, 'compiled_types', ('article-journal', 'chapter', 'book'))
+        stats = quickbib.Stats()
+        assert f(l, multi = True, formatter = formatter, return_cites_and_keys = True,
+            stats = stats) == expected
+        assert stats.counters['compiled entries'] == 7
+        assert stats.counters['compiled fallbacks'] == 0
+        assert quickbib.cites(environ['APA_CSL_PATH'], l, formatter = formatter) == expected_cites
+
+def test_threads(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    import sys
+    monkeypatch.setattr(quickbib, 'entry_cache', None)
+    l = [jf(title = 'Title {}'.format(i), author = [name('Aaa', 'Alfa{}'.format(i))])
+        for i in range(10)]
+    formatters = ['html', 'plain', 'chocolate'] * 10
+    expected = {fm: f(l, multi = True, formatter = fm) for fm in set(formatters)}
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+      # So that the threads interleave as much as possible.
+    try:
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(
+                lambda fm: f(l, multi = True, formatter = fm), formatters))
+    finally:
+        sys.setswitchinterval(interval)
+    assert results == [expected[fm] for fm in formatters]